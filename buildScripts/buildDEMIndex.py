@@ -17,144 +17,387 @@ some inspiration at https://dwtkns.com/srtm30m/
 direct access to TNM data at https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/
 '''
 
+import os
+
 # Edit these as needed:
 inputCoverage = r"./indices/FESM_1m_IL_MO_TN.shp"
 inputCoverageFields = ["project", "product_li"]
 outputCoverageDir = r"output"
 outputCoverageFile = r"1m_usgs_dem_coverage.shp"
 tempDir = r"tempData"
-
-
-import arcpy
-import os
-import urllib3
-import shutil
+journalFile = r"indexJournal.sqlite"   # record of finished/failed TIFs, used to resume and to rebuild the output
+retryFailed = True          # try TIFs that failed on a previous run again
+rebuildFromJournal = False  # recreate the output shapefile from the journal's footprints, then carry on
+refreshMode = True          # use conditional requests against the cached directory listings, so unchanged projects
+                            # cost one 304 each, and re-footprint TIFs whose listed modified date has changed
+downloadWorkers = 8         # TIFs downloading at the same time
+perHostLimit = 4            # connections to any one server
+hostLimits = {}             # per-server overrides, ie. {"rockyweb.usgs.gov": 2}
+maxPendingTiffs = 16        # downloaded TIFs allowed to wait in tempDir for footprinting
+footprintMode = "download"  # "download": whole TIF, outline traced from its nodata mask
+                            # "header": bbox from the TIF header, read with HTTP range requests (a few KB per tile)
+                            # "overview": outline traced from the smallest overview, read through GDAL /vsicurl/
+footprintMaskSize = 2048    # longest side of the mask the outline is traced from, in cells
+footprintTolerance = 1.0    # outline simplification, in mask cells
+footprintWorkers = max(1, (os.cpu_count() or 3) - 2)  # processes tracing outlines (leave cores for downloads and the writer)
+writerBatchSize = 500       # footprints written to the output (and journal) per batch
+writerFlushSeconds = 30     # write a partial batch if nothing new has arrived for this long
+
+
+sizeFields = ["bytes", "ncols", "nrows"]    # per-TIF download size and pixel dimensions, for estimating jobs before they run
+
+# arcpy is imported in the functions that use it: under spawn the footprint workers re-import this script and
+# don't need it (the writer process and this one import it when they get to them)
+import sys
 import re
-import zipfile
-
-# Create output shapefile
-if not os.path.exists(outputCoverageDir):
-    cmd = f"mkdir {outputCoverageDir}"
-    os.system(cmd)
-if not os.path.exists(os.path.join(outputCoverageDir, outputCoverageFile)):
-    arcpy.management.CreateFeatureclass(os.path.abspath(outputCoverageDir), outputCoverageFile, "POLYGON", None, "DISABLED", "DISABLED", 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]];-400 -400 1000000000;-100000 10000;-100000 10000;8.98315284119521E-09;0.001;0.001;IsHighPrecision', '', 0, 0, 0, '')
-    arcpy.management.AddFields(os.path.abspath(os.path.join(outputCoverageDir, outputCoverageFile)), "project TEXT # 255 # #;link TEXT # 400 # #;linkaws TEXT # 400 # #")
-
-# Create Temp Directory
-if not os.path.exists(tempDir):
-    cmd = f"mkdir {tempDir}"
-    os.system(cmd)
-
-# Open shapefile and iterate features
-areaCounter = 0
-with arcpy.da.SearchCursor(inputCoverage, inputCoverageFields) as inputCoverageCursor:
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from osgeo import gdal
+
+# Shared download engine lives with the toolbox scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py", "datareq"))
+from downloader import DownloadEngine
+from remoteTiff import readTiffHeader, headerBounds, overviewFootprint
+from footprint import rasterFootprint
+from indexJournal import IndexJournal
+
+
+def getTiffDir(productLink):
+    httpTiffDir = productLink + "/TIFF"
+    # Switch URL to USGS Server instead of Amazon, bc its easier to scrape for the TIF files
+    httpTiffDir = httpTiffDir.replace("http://prd-tnm.s3.amazonaws.com/index.html?prefix=StagedProducts/", "https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/")
+    # Patch because they changed some of the directories to use underscores w/o updating index
+    httpTiffDir = httpTiffDir.replace("-", "_")
+    httpTiffDir = httpTiffDir.replace("prd_tnm", "prd-tnm")
+    return httpTiffDir
+
+
+def listTiffs(engine, journal, httpTiffDir):
+    # Returns ({tif: modified stamp from the listing}, {tif: stamp in the cached listing}), or (None, None) if the
+    # directory couldn't be reached
+    # Whether a tile has changed is decided against the stamp recorded with its footprint (see changedTiff), not
+    # the cached listing, which is stored straight away
+    cached = journal.listing(httpTiffDir) if refreshMode else None
+    headers = {}
+    if cached is not None:
+        etag, lastModified, cachedTiffs = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if lastModified:
+            headers["If-Modified-Since"] = lastModified
+
+    r = engine.get(httpTiffDir, headers=headers)
+    if r.status == 304:
+        # Nothing new on the server; anything in the cached listing that isn't done yet still gets picked up
+        print(f"No changes in {httpTiffDir}")
+        return cachedTiffs, cachedTiffs
+    if r.status != 200:
+        print(f"ERROR reaching {httpTiffDir}")
+        return None, None
+
+    tiffs = parseListing(r.data.decode("utf-8", "replace"))
+    journal.recordListing(httpTiffDir, r.headers.get("ETag"), r.headers.get("Last-Modified"), tiffs)
+    return tiffs, cachedTiffs if cached is not None else {}
+
+
+def changedTiff(stamp, doneStamp, cachedStamp):
+    # Whether a finished tile listed with stamp has changed since it was footprinted; tiles done before stamps
+    # were recorded fall back to the stamp in the cached listing
+    known = doneStamp or cachedStamp
+    return bool(refreshMode and stamp and known not in (None, stamp))
+
+
+def parseListing(html):
+    # Find all tifs on page
+    matches = re.findall(r'USGS.*?tif', html)
+    # and remove duplicates (from links)
+    tiffs = dict.fromkeys(matches)
+    # The directory index lists a modified date after each link; keep it so changed tiles can be spotted later
+    for chunk in html.split('href="')[1:]:
+        link = re.match(r'(USGS[^"]*?\.tif)"', chunk)
+        stamp = re.search(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}', chunk)
+        if link and stamp and link.group(1) in tiffs:
+            tiffs[link.group(1)] = stamp.group(0)
+    return tiffs
+
+
+def footprintFile(savePath, maskSize, tolerance):
+    # Runs in the worker processes: trace the data outline of the TIF in memory, then delete it
+    # Returns (rings, projection, (bytes, ncols, nrows))
+    rings, projection = rasterFootprint(savePath, maskSize, tolerance)
+    ds = gdal.Open(savePath)
+    size = (os.path.getsize(savePath), ds.RasterXSize, ds.RasterYSize)
+    ds = None
+    os.remove(savePath)
+    return rings, projection, size
+
+
+def remoteFootprint(engine, httpPath):
+    # Runs on the download threads; only plain values come back, arcpy geometry is built in the writer process
+    # Returns (epsg, rings, (bytes, ncols, nrows))
+    header = readTiffHeader(engine, httpPath)
+    size = (int(engine.head(httpPath).get("Content-Length") or 0), header["width"], header["height"])
+    if header["epsg"] is None:
+        raise ValueError(f"No EPSG code in the header of {httpPath}")
+    if footprintMode == "overview":
+        rings = overviewFootprint(httpPath, footprintTolerance)
+    else:
+        xmin, ymin, xmax, ymax = headerBounds(header)
+        rings = [[(xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)]]
+    return header["epsg"], rings, size
+
+
+def ringsPolygon(rings, srDef):
+    # srDef is either an EPSG code or a projection WKT string
+    import arcpy
+    if not rings:
+        raise ValueError("No valid data in raster")
+    if isinstance(srDef, int):
+        sr = arcpy.SpatialReference(srDef)
+    else:
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(srDef)
+    parts = arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in ring]) for ring in rings])
+    return arcpy.Polygon(parts, sr)
+
+
+def syncJournal(journal, outFilePath):
+    # Anything in the output that the journal doesn't know about (ie. written just before a crash, or by
+    # an older version of this script) is recorded as done, so it isn't added twice
+    import arcpy
+    doneLinks = journal.doneLinks()
+    with arcpy.da.SearchCursor(outFilePath, ["Shape@WKT", "project", "link", "linkaws"] + sizeFields) as cursor:
+        for wkt, project, link, linkaws, *size in cursor:
+            if linkaws not in doneLinks:
+                journal.recordDone(linkaws, project, link, [wkt], size, commit=False)
+                doneLinks.add(linkaws)
+    journal.commit()
+
+
+def rebuildOutput(journal, outFilePath):
+    import arcpy
+    print(f"Rebuilding {outFilePath} from {journalFile}")
+    outSR = arcpy.Describe(outFilePath).spatialReference
+    arcpy.management.DeleteRows(outFilePath)
+    with arcpy.da.InsertCursor(outFilePath, ["Shape@", "project", "link", "linkaws"] + sizeFields) as outCursor:
+        for project, link, linkaws, footprints, size in journal.footprints():
+            for wkt in footprints:
+                outCursor.insertRow([arcpy.FromWKT(wkt, outSR), project, link, linkaws] + list(size))
+
+
+def indexWriter(writeQueue, outFilePath, batchSize, flushSeconds):
+    # The only process that writes to the output and the journal; footprints arrive on writeQueue as
+    # ("done" or "replace", project, link, linkaws, rings, srDef, size, stamp) or ("failed", project, link, linkaws, error),
+    # and None ends it
+    # Each batch is one InsertCursor and one journal transaction
+    import arcpy
     try:
-        for row in inputCoverageCursor:
-            projectName = row[0]
-            httpTiffDir = row[1] + "/TIFF"
-            # Switch URL to USGS Server instead of Amazon, bc its easier to scrape for the TIF files
-            httpTiffDir = httpTiffDir.replace("http://prd-tnm.s3.amazonaws.com/index.html?prefix=StagedProducts/", "https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/")
-            # Patch because they changed some of the directories to use underscores w/o updating index
-            httpTiffDir = httpTiffDir.replace("-", "_")
-            httpTiffDir = httpTiffDir.replace("prd_tnm", "prd-tnm")
-
-
-            http = urllib3.PoolManager()
-            r = http.request('GET', httpTiffDir)
-            if r.status != 200:
-                print(f"ERROR reaching {httpTiffDir}")
+        outSR = arcpy.Describe(outFilePath).spatialReference
+        journal = IndexJournal(journalFile)
+        batch = []
+        finished = False
+        written = 0
+        while not finished:
+            try:
+                message = writeQueue.get(timeout=flushSeconds)
+                idle = False
+            except queue.Empty:
+                message = ()
+                idle = True
+            if message is None:
+                finished = True
+            elif message:
+                batch.append(message)
+            if batch and (finished or idle or len(batch) >= batchSize):
+                written += writeBatch(batch, outFilePath, outSR, journal)
+                batch = []
+                print(f"{written} footprints written")
+        journal.close()
+    except Exception as e:
+        print(f"ERROR in the index writer: {e}")
+        raise
+
+
+def sendToWriter(writeQueue, writer, message):
+    # writeQueue is bounded, so put blocks while it is full; if the writer has died nothing will ever empty it,
+    # so give up instead of waiting forever
+    while True:
+        try:
+            writeQueue.put(message, timeout=5)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError(f"The index writer stopped (exit code {writer.exitcode}); see its error above")
+
+
+def writeBatch(batch, outFilePath, outSR, journal):
+    # Tiles that changed on the server lose their old footprint first
+    import arcpy
+    replaced = {message[3] for message in batch if message[0] == "replace"}
+    if replaced:
+        with arcpy.da.UpdateCursor(outFilePath, ["linkaws"]) as cursor:
+            for row in cursor:
+                if row[0] in replaced:
+                    cursor.deleteRow()
+
+    written = 0
+    with arcpy.da.InsertCursor(outFilePath, ["Shape@", "project", "link", "linkaws"] + sizeFields) as outCursor:
+        for message in batch:
+            status, projectName, linkRocky, httpPath = message[:4]
+            if status == "failed":
+                journal.recordFailure(httpPath, projectName, linkRocky, message[4], commit=False)
+                continue
+            try:
+                rings, srDef, size, stamp = message[4:]
+                poly = ringsPolygon(rings, srDef).projectAs(outSR)
+                outCursor.insertRow([poly, projectName, linkRocky, httpPath] + list(size))
+            except Exception as e:
+                print(f"ERROR writing {httpPath}: {e}")
+                journal.recordFailure(httpPath, projectName, linkRocky, e, commit=False)
+                continue
+            journal.recordDone(httpPath, projectName, linkRocky, [poly.WKT], size, stamp, commit=False)
+            written += 1
+    journal.commit()
+    return written
+
+
+def main():
+    import arcpy
+
+    # Create output shapefile
+    if not os.path.exists(outputCoverageDir):
+        cmd = f"mkdir {outputCoverageDir}"
+        os.system(cmd)
+    if not os.path.exists(os.path.join(outputCoverageDir, outputCoverageFile)):
+        arcpy.management.CreateFeatureclass(os.path.abspath(outputCoverageDir), outputCoverageFile, "POLYGON", None, "DISABLED", "DISABLED", 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]];-400 -400 1000000000;-100000 10000;-100000 10000;8.98315284119521E-09;0.001;0.001;IsHighPrecision', '', 0, 0, 0, '')
+        arcpy.management.AddFields(os.path.abspath(os.path.join(outputCoverageDir, outputCoverageFile)), "project TEXT # 255 # #;link TEXT # 400 # #;linkaws TEXT # 400 # #")
+    # Outputs from before tile sizes were recorded get the size fields (empty for the TIFs already in there)
+    existingFields = [field.name for field in arcpy.ListFields(os.path.join(outputCoverageDir, outputCoverageFile))]
+    if not all(field in existingFields for field in sizeFields):
+        arcpy.management.AddFields(os.path.abspath(os.path.join(outputCoverageDir, outputCoverageFile)), "bytes DOUBLE # # # #;ncols LONG # # # #;nrows LONG # # # #")
+
+    # Create Temp Directory
+    if not os.path.exists(tempDir):
+        cmd = f"mkdir {tempDir}"
+        os.system(cmd)
+
+    outFilePath = os.path.abspath(os.path.join(outputCoverageDir, outputCoverageFile))
+
+    # Open the journal and work out what has already been done
+    journal = IndexJournal(journalFile)
+    if rebuildFromJournal:
+        rebuildOutput(journal, outFilePath)
+    else:
+        syncJournal(journal, outFilePath)
+    skipLinks = journal.doneLinks(includeFailed=not retryFailed)
+    doneStamps = journal.doneStamps()
+    print(f"{len(skipLinks)} TIFs already done")
+
+    # Everything gets written by a single writer process, in batches
+    writeQueue = multiprocessing.Queue(maxsize=writerBatchSize * 4)
+    writer = multiprocessing.Process(target=indexWriter, args=(writeQueue, outFilePath, writerBatchSize, writerFlushSeconds))
+    writer.start()
+
+    def send(message):
+        sendToWriter(writeQueue, writer, message)
+
+    # Footprints being traced in the worker processes, future -> (status, projectName, linkRocky, httpPath, stamp)
+    footprinting = {}
+
+    def collectFootprints(block=False):
+        # Pass finished outlines on to the writer; with block, wait for at least one to finish
+        if block:
+            wait(footprinting, return_when=FIRST_COMPLETED)
+        for future in [f for f in footprinting if f.done()]:
+            status, projectName, linkRocky, httpPath, stamp = footprinting.pop(future)
+            if future.exception() is not None:
+                print(f"ERROR footprinting {httpPath}: {future.exception()}")
+                send(("failed", projectName, linkRocky, httpPath, str(future.exception())))
             else:
-                # Find all tifs on page
-                matches = re.findall(r'USGS.*?tif', str(r.data))
-                # and remove duplicates (from links)
-                matches = list(dict.fromkeys(matches))
-
-                print(f"{len(matches)} matches in {httpTiffDir}")
-
-                if len(matches) < 50000:
+                rings, projection, size = future.result()
+                send((status, projectName, linkRocky, httpPath, rings, projection, size, stamp))
+
+    # Open shapefile and iterate features
+    # One engine (and connection pool) for the whole run; TIFs download in the background while
+    # the ones already on disk are footprinted by the process pool
+    areaCounter = 0
+    with journal, DownloadEngine(downloadWorkers, perHostLimit, hostLimits) as engine, ProcessPoolExecutor(footprintWorkers) as pool, arcpy.da.SearchCursor(inputCoverage, inputCoverageFields) as inputCoverageCursor:
+        try:
+            for row in inputCoverageCursor:
+                projectName = row[0]
+                httpTiffDir = getTiffDir(row[1])
+
+                matches, cachedTiffs = listTiffs(engine, journal, httpTiffDir)
+                if matches is not None:
+                    print(f"{len(matches)} matches in {httpTiffDir}")
+
+                if matches is not None and len(matches) < 50000:
                     print(f"Retrieving {len(matches)} tifs from {projectName}")
-                    # Download each TIF to tempDir
-                    tifCount = 0
-                    for tif in matches:
-                        tifCount += 1
-                        savePath = os.path.abspath(os.path.join(tempDir, tif))
-                        httpPath = httpTiffDir + "/" + tif
-
-                        # Switch URL to back to Amazon Server, bc its way faster to download
-                        linkRocky = httpPath
-                        httpPath = httpPath.replace("https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/", "http://prd-tnm.s3.amazonaws.com/StagedProducts/")
-
-                        # If it's already been added to the output, skip this row
-                        alreadyDone = False                        
-                        with arcpy.da.SearchCursor(os.path.abspath(os.path.join(outputCoverageDir, outputCoverageFile)), ["linkaws"]) as checkCursor:
-                            for row in checkCursor:
-                                if row[0] == httpPath:
-                                    # print(f"Already got {httpPath}")
-                                    alreadyDone = True
-                        if alreadyDone or (projectName == "IL_HicksDome_FluorsparDistrict_2019_D19" and tifCount == 155): # FOR SOME REASON THIS ONE TIF BREAKS THINGS, I ADDED IT TO OUTPUT MANUALLY
-                            # print(f"Skipping {tifCount}")
-                            continue
-
-                        with http.request('GET', httpPath, preload_content=False) as resp, open(savePath, 'wb') as out_file:
-                            if resp.status != 200:
-                                print(f"ERROR reaching {httpPath}")
-                            else:
-                                # Save the output file
-                                shutil.copyfileobj(resp, out_file)
-    
-                                # Convert the raster to two bits, one of which is nodata
-                                savePathTemp = os.path.abspath(os.path.join(tempDir, "temp_" + tif))
-                                arcpy.management.CopyRaster(savePath, savePathTemp, '', None, "0", "NONE", "NONE", "2_BIT", "NONE", "NONE", 'TIFF', "NONE", "CURRENT_SLICE", "NO_TRANSPOSE")
-                                # NOTE: for some reason I can't remember, I had this set at 2_BIT, which worked for every DEM except one; really it should be 1_BIT though, which ought to work ??
-                                # TODO
-                                # arcpy.management.CopyRaster(savePath, savePathTemp, '', None, "0", "NONE", "NONE", "1_BIT", "NONE", "NONE", "TIFF", "NONE", "CURRENT_SLICE", "NO_TRANSPOSE")
-
-                                # Convert the temp raster to a polygon
-                                tempShp = os.path.abspath(os.path.join(tempDir, "temp.shp"))
-                                arcpy.env.outputZFlag = "Disabled"
-                                arcpy.env.outputMFlag = "Disabled"
-                                arcpy.conversion.RasterToPolygon(savePathTemp, tempShp, "SIMPLIFY", "Value", "SINGLE_OUTER_PART", None)
-                                
-                                # Reproject - not actually necessary!
-                                # tempShpProject = os.path.abspath(os.path.join(tempDir, "tempProj.shp"))
-                                # arcpy.management.Project(tempShp, tempShpProject, 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]', "WGS_1984_(ITRF00)_To_NAD_1983", 'PROJCS["NAD_1983_UTM_Zone_15N",GEOGCS["GCS_North_American_1983",DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-93.0],PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]', "NO_PRESERVE_SHAPE", None, "NO_VERTICAL")
-
-                                # Merge the temp polygon into the output file
-                                outFilePath = os.path.abspath(os.path.join(outputCoverageDir, outputCoverageFile))
-                                with arcpy.da.InsertCursor(outFilePath, ["Shape@", "project", "link", "linkaws"]) as outCursor:
-                                    for poly in arcpy.da.SearchCursor(tempShp, ["Shape@"]):
-                                        outCursor.insertRow([poly[0], projectName, linkRocky, httpPath])
-
-                                
-
-                        # Empty the temp directory
-                        for file in os.scandir(tempDir):
-                            os.remove(file.path)
-
-                        resp.release_conn()
-
-                        # exit()
-                        # Backup every 10 iterations
-                        if tifCount % 10 == 0:
-                            filenames = os.listdir(outputCoverageDir)
-                            with zipfile.ZipFile(rf"zips\bak_{projectName}_{tifCount}.zip", mode="w") as archive:
-                                for filename in filenames:
-                                    if not filename.endswith(".lock"):
-                                        archive.write(os.path.join(outputCoverageDir, filename))
-
-
-            # Get link and find TIFF directory
-            # Download each TIF to tempDir
-            # Get extent of each TIF
-            # Make sure extent is in EPSG 4269
-            # Append feature to output shapefile, including link to the TIF and project name
-
-            areaCounter += 1
-    except Exception as e:
-        print(e)
-
 
-print(areaCounter)
+                    # Queue up each TIF that still needs doing, to download to tempDir
+                    def tiffJobs():
+                        for tif in matches:
+                            savePath = os.path.abspath(os.path.join(tempDir, tif))
+                            httpPath = httpTiffDir + "/" + tif
+
+                            # Switch URL to back to Amazon Server, bc its way faster to download
+                            linkRocky = httpPath
+                            httpPath = httpPath.replace("https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/", "http://prd-tnm.s3.amazonaws.com/StagedProducts/")
+
+                            # If it's already been added to the output (and hasn't changed since), skip this row
+                            changed = httpPath in skipLinks and changedTiff(matches[tif], doneStamps.get(httpPath), cachedTiffs.get(tif))
+                            if httpPath in skipLinks and not changed:
+                                continue
+
+                            yield httpPath, savePath, (linkRocky, httpPath, "replace" if changed else "done", matches[tif])
+
+                    # Footprint each TIF as soon as it has downloaded (or its header has been read)
+                    if footprintMode == "download":
+                        results = engine.downloadAll(tiffJobs(), maxPendingTiffs)
+                    else:
+                        results = engine.runAll(remoteFootprint, (((engine, httpPath), tag) for httpPath, savePath, tag in tiffJobs()), maxPendingTiffs)
+                    for (linkRocky, httpPath, status, stamp), result, error in results:
+                        if error is not None:
+                            print(error)
+                            send(("failed", projectName, linkRocky, httpPath, str(error)))
+                        elif footprintMode == "download":
+                            # Don't let downloaded TIFs pile up in tempDir faster than they can be traced
+                            while len(footprinting) >= maxPendingTiffs + footprintWorkers:
+                                collectFootprints(block=True)
+                            footprinting[pool.submit(footprintFile, result, footprintMaskSize, footprintTolerance)] = (status, projectName, linkRocky, httpPath, stamp)
+                        else:
+                            epsg, rings, size = result
+                            send((status, projectName, linkRocky, httpPath, rings, epsg, size, stamp))
+                        collectFootprints()
+                        skipLinks.add(httpPath)
+
+
+                # Get link and find TIFF directory
+                # Download each TIF to tempDir
+                # Get extent of each TIF
+                # Make sure extent is in EPSG 4269
+                # Append feature to output shapefile, including link to the TIF and project name
+
+                areaCounter += 1
+        except Exception as e:
+            print(e)
+
+        # Finish off the outlines still being traced
+        while footprinting:
+            collectFootprints(block=True)
+
+    # Let the writer finish its last batch
+    send(None)
+    writer.join()
+    if writer.exitcode != 0:
+        raise RuntimeError(f"The index writer stopped (exit code {writer.exitcode}); see its error above")
+
+    print(areaCounter)
+
+
+if __name__ == '__main__':
+    main()
 
 
 
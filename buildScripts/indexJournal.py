@@ -0,0 +1,108 @@
+'''
+Append-only journal of the DEM index build, kept in SQLite (WAL mode)
+Every TIF that gets footprinted (or fails) is recorded here as soon as it is written to the output, so a
+crashed or stopped run can pick up where it left off, and the output shapefile can be rebuilt from the
+recorded footprints if it gets corrupted
+The TIFF directory listings are cached here too (with their ETag/Last-Modified), for incremental refreshes;
+each finished tile keeps the modified stamp it was listed with, so a change is only forgotten once it is rebuilt
+'''
+
+import json
+import sqlite3
+import time
+
+
+class IndexJournal:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)     # the writer process and the main process share it
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")     # WAL + NORMAL is still safe against a crashed process
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                linkaws TEXT PRIMARY KEY,
+                project TEXT,
+                link TEXT,
+                status TEXT,
+                footprint TEXT,
+                error TEXT,
+                updated REAL,
+                bytes INTEGER,
+                ncols INTEGER,
+                nrows INTEGER,
+                stamp TEXT
+            )""")
+        # Journals from before tile sizes and stamps were recorded
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(tiles)")}
+        for column, columnType in (("bytes", "INTEGER"), ("ncols", "INTEGER"), ("nrows", "INTEGER"), ("stamp", "TEXT")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE tiles ADD COLUMN {column} {columnType}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tiles_project ON tiles (project)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS listings (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                lastModified TEXT,
+                tiles TEXT,
+                checked REAL
+            )""")
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def isDone(self, linkaws):
+        return self.db.execute("SELECT 1 FROM tiles WHERE linkaws = ? AND status = 'done'", (linkaws,)).fetchone() is not None
+
+    def doneLinks(self, includeFailed=False):
+        # Set of linkaws already handled, for constant-time skip checks while queueing a project
+        statuses = ("done", "failed") if includeFailed else ("done",)
+        rows = self.db.execute(f"SELECT linkaws FROM tiles WHERE status IN ({','.join('?' * len(statuses))})", statuses)
+        return {row[0] for row in rows}
+
+    def recordDone(self, linkaws, project, link, footprints, size=None, stamp=None, commit=True):
+        # footprints is a list of WKT strings in the output coordinate system; size is (bytes, ncols, nrows) if known
+        # stamp is the modified date the tile was listed with when it was footprinted
+        nBytes, ncols, nrows = size or (None, None, None)
+        self.db.execute("INSERT OR REPLACE INTO tiles (linkaws, project, link, status, footprint, error, updated, bytes, ncols, nrows, stamp) VALUES (?, ?, ?, 'done', ?, NULL, ?, ?, ?, ?, ?)",
+                        (linkaws, project, link, "\n".join(footprints), time.time(), nBytes, ncols, nrows, stamp))
+        if commit:
+            self.db.commit()
+
+    def recordFailure(self, linkaws, project, link, error, commit=True):
+        # Never overwrite a tile that has already been done
+        self.db.execute("INSERT OR IGNORE INTO tiles (linkaws, project, link, status, footprint, error, updated) VALUES (?, ?, ?, 'failed', NULL, ?, ?)", (linkaws, project, link, str(error), time.time()))
+        self.db.execute("UPDATE tiles SET error = ?, updated = ? WHERE linkaws = ? AND status = 'failed'", (str(error), time.time(), linkaws))
+        if commit:
+            self.db.commit()
+
+    def doneStamps(self):
+        # {linkaws: listed modified stamp} for the finished tiles that have one
+        return dict(self.db.execute("SELECT linkaws, stamp FROM tiles WHERE status = 'done' AND stamp IS NOT NULL"))
+
+    def commit(self):
+        self.db.commit()
+
+    def failures(self):
+        return self.db.execute("SELECT linkaws, project, error FROM tiles WHERE status = 'failed' ORDER BY updated").fetchall()
+
+    def footprints(self):
+        # (project, link, linkaws, [WKT, ...], (bytes, ncols, nrows)) for every finished tile, in the order they were done
+        for linkaws, project, link, footprint, nBytes, ncols, nrows in self.db.execute("SELECT linkaws, project, link, footprint, bytes, ncols, nrows FROM tiles WHERE status = 'done' ORDER BY updated"):
+            yield project, link, linkaws, footprint.split("\n") if footprint else [], (nBytes, ncols, nrows)
+
+    def listing(self, url):
+        # (etag, lastModified, {tif: modified stamp}) from the last time url was listed, or None
+        row = self.db.execute("SELECT etag, lastModified, tiles FROM listings WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def recordListing(self, url, etag, lastModified, tiles):
+        self.db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)", (url, etag, lastModified, json.dumps(tiles), time.time()))
+        self.db.commit()
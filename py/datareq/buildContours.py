@@ -3,51 +3,206 @@ Geoprocessing Tool which builds contour lines from an input DEM
 The steps follow TWM Geo's standard method for outputting z-enabled contour lines that open correctly in CAD software
 '''
 
-import arcpy
+focalEngine = "arcpy"       # "arcpy": arcpy.ia.FocalStatistics over the whole DEM
+                            # "numpy": tiled focal mean on a process pool (focalMean.py), for DEMs GDAL can read; with the
+                            # gdal contour engine the contour workers smooth each block themselves, with no scratch raster
+contourEngine = "arcpy"     # "arcpy": arcpy.ddd.Contour over the whole DEM
+                            # "gdal": gdal.ContourGenerate in tiles on a process pool, stitched at the seams (tiledContours.py)
+contourTolerance = 0        # gdal engine: how far (in the DEM's linear units) simplified contours may stray from the
+                            # full-detail lines; ie. 0.1 drops the near-collinear vertices that slow CAD down (0 keeps them all)
+contourBatchSize = 20000    # contour lines buffered per write; each batch is one edit operation in a geodatabase
+
+# arcpy is imported where it is used: under spawn the focalMean and tiledContours workers re-import this script,
+# and they don't need it
 import os
+import math
+import shutil
+import tempfile
+import contextlib
+from fractions import Fraction
+from focalMean import focalMean, feetPerMeter
+from tiledContours import contourLines
 
 def buildContours(inputDEM, outDir, outFilename, contourInterval, srs):
-    # Run Focal Statistics function
-    arcpy.AddMessage("Running Focal Statistics with cell size of 5...")
-    arcpy.SetProgressor("default", f"Running Focal Statistics with cell size of 5")
-    rasterFocalStats = arcpy.ia.FocalStatistics(inputDEM, "Rectangle 5 5 CELL", "MEAN", "DATA", 90);
-
-    # Get SR of raster
-    sr = arcpy.Raster(rasterFocalStats).getRasterInfo().getSpatialReference()
-    # Get Units
+    # contourInterval can be a list of intervals ("1;2;5"); the DEM is smoothed and converted once and each
+    # interval gets its own output, named outFilename with the interval added
+    import arcpy
+
+    # Get SR and units of the DEM, once, up front
+    desc = arcpy.Describe(inputDEM)
+    demPath = desc.catalogPath
+    sr = desc.spatialReference
     units = sr.linearUnitName
     arcpy.AddMessage(f"Linear Units of Raster: {units}")
-
-    # Convert Units if necessary
     if units == "Meter":
         arcpy.AddMessage("Raster units are in meters, converting to feet...")
-        arcpy.SetProgressor("default", f"Converting units to feet")
-        rasterFt = arcpy.ia.UnitConversion(rasterFocalStats, "Meters", "Feet")
+        scale = feetPerMeter
     elif units == "Foot" or units == "Foot_US":
         arcpy.AddMessage("Raster units are in feet...")
-        rasterFt = rasterFocalStats
+        scale = 1.0
     else:
         arcpy.AddError("Raster units are not in meters or feet!")
+        return []
 
-    # Build Contours
-    arcpy.AddMessage("Creating z-enabled contours...")
-    arcpy.SetProgressor("default", f"Creating z-enabled contours...")
-    arcpy.env.outputCoordinateSystem = srs
-    arcpy.env.outputZFlag = "Enabled"
-    savefile = os.path.join(outDir, outFilename)
-    arcpy.ddd.Contour(rasterFt, savefile, int(contourInterval), 0, 1, "CONTOUR", None)
+    # Scratch rasters go in a folder of this run's own, removed once the contours are built
+    workDir = tempfile.mkdtemp(prefix="contours_", dir=arcpy.env.scratchFolder)
+    try:
+        # Run Focal Statistics function (and the unit conversion)
+        arcpy.AddMessage("Running Focal Statistics with cell size of 5...")
+        arcpy.SetProgressor("default", f"Running Focal Statistics with cell size of 5")
+        fused = focalEngine == "numpy" and os.path.isfile(demPath)
+        smoothing = 0
+        if fused and contourEngine == "gdal":
+            # The contour workers smooth and convert each block as they read it, so nothing is written in between
+            rasterFt = demPath
+            smoothing = 5
+        elif fused:
+            # Mean and conversion in the same pass, to one scratch raster
+            arcpy.SetProgressor("step", f"Running Focal Statistics with cell size of 5", 0, 100, 1)
+            rasterFt = focalMean(demPath, os.path.join(workDir, "focal_ft.tif"), 5, scale=scale,
+                                 progress=lambda fraction: arcpy.SetProgressorPosition(int(fraction * 100)))
+            arcpy.ResetProgressor()
+        else:
+            rasterFocalStats = arcpy.ia.FocalStatistics(inputDEM, "Rectangle 5 5 CELL", "MEAN", "DATA", 90);
+            if scale != 1.0:
+                arcpy.SetProgressor("default", f"Converting units to feet")
+                rasterFt = arcpy.ia.UnitConversion(rasterFocalStats, "Meters", "Feet")
+            else:
+                rasterFt = rasterFocalStats
+
+        # Build Contours
+        arcpy.AddMessage("Creating z-enabled contours...")
+        arcpy.SetProgressor("default", f"Creating z-enabled contours...")
+        arcpy.env.outputCoordinateSystem = srs
+        arcpy.env.outputZFlag = "Enabled"
+        intervals = parseIntervals(contourInterval)
+        outputs = {interval: os.path.join(outDir, intervalFilename(outFilename, interval, len(intervals) > 1)) for interval in intervals}
+        if contourEngine == "gdal":
+            # The workers read the DEM with GDAL, so it has to be a file
+            if not isinstance(rasterFt, str):
+                ftPath = os.path.join(workDir, "dem_ft.tif")
+                arcpy.Raster(rasterFt).save(ftPath)
+                rasterFt = ftPath
+            # One pass at the interval all of them are multiples of; each line goes to every output it belongs in
+            baseInterval = commonInterval(intervals)
+            arcpy.SetProgressor("step", f"Creating z-enabled contours...", 0, 100, 1)
+            stats = {}
+            lines = contourLines(rasterFt, baseInterval, 0, progress=lambda fraction: arcpy.SetProgressorPosition(int(fraction * 100)),
+                                 window=smoothing, scale=scale if smoothing else 1.0, tolerance=contourTolerance, stats=stats)
+            counts = writeContours(lines, outputs, sr)
+            arcpy.ResetProgressor()
+            for interval, count in counts.items():
+                arcpy.AddMessage(f"{count} contour lines written at {interval:g} ft intervals")
+            if contourTolerance > 0 and stats["verticesOut"]:
+                arcpy.AddMessage(f"Simplified to {stats['verticesOut']:,} of {stats['verticesIn']:,} vertices "
+                                 f"({stats['verticesIn'] / stats['verticesOut']:.1f}x fewer, within {contourTolerance} {units})")
+        elif len(intervals) > 1:
+            # One Contour run at the interval all of them are multiples of, split into the outputs by elevation
+            baseFile = os.path.join(workDir, "contours.shp")
+            arcpy.ddd.Contour(rasterFt, baseFile, commonInterval(intervals), 0, 1, "CONTOUR", None)
+            with arcpy.da.SearchCursor(baseFile, ["Contour", "Shape@"]) as cursor:
+                counts = writeContours(cursor, outputs, sr)
+            for interval, count in counts.items():
+                arcpy.AddMessage(f"{count} contour lines written at {interval:g} ft intervals")
+        else:
+            arcpy.ddd.Contour(rasterFt, outputs[intervals[0]], intervals[0], 0, 1, "CONTOUR", None)
+    finally:
+        rasterFt = None
+        for scratchFile in ("focal_ft.tif", "dem_ft.tif", "contours.shp"):
+            if arcpy.Exists(os.path.join(workDir, scratchFile)):
+                arcpy.management.Delete(os.path.join(workDir, scratchFile))
+        shutil.rmtree(workDir, ignore_errors=True)
 
     # Add Contours to Map
     aprx = arcpy.mp.ArcGISProject("CURRENT")
-    aprx.activeMap.addDataFromPath(savefile)
+    for savefile in outputs.values():
+        aprx.activeMap.addDataFromPath(savefile)
     arcpy.AddMessage("Contours added to map")
 
 
     arcpy.AddMessage("Success!")
 
+    return list(outputs.values())
+
+
+def parseIntervals(contourInterval):
+    # "2", "1;2;5" or "1, 2, 5" -> sorted list of intervals
+    values = [float(value) for value in str(contourInterval).replace(",", ";").split(";") if value.strip()]
+    return sorted({int(value) if value.is_integer() else value for value in values})
+
+
+def intervalFilename(outFilename, interval, multiple):
+    # Only add the interval to the name when there is more than one output
+    if not multiple:
+        return outFilename
+    name, extension = os.path.splitext(outFilename)
+    return f"{name}_{f'{interval:g}'.replace('.', '_')}ft{extension}"
+
+
+def commonInterval(intervals):
+    # Largest interval that every one of intervals is a whole multiple of (ie. 2 and 5 -> 1, 0.5 and 2 -> 0.5)
+    fractions = [Fraction(interval).limit_denominator(1000) for interval in intervals]
+    denominator = math.lcm(*[fraction.denominator for fraction in fractions])
+    numerator = math.gcd(*[int(fraction * denominator) for fraction in fractions])
+    return numerator / denominator
+
+
+def onInterval(elevation, interval):
+    return abs(elevation / interval - round(elevation / interval)) < 1e-6
+
+
+def writeContours(lines, outputs, demSR, batchSize=contourBatchSize):
+    # Write (elevation, coordinates or polyline) lines as z-enabled polylines with the Id and Contour fields that
+    # arcpy.ddd.Contour gives, in the output coordinate system if one is set
+    # outputs is {interval: feature class}; each line goes to the outputs whose interval it falls on
+    # Lines are consumed as they come and written batchSize at a time, so only one batch is ever held
+    # Returns {interval: number of lines written}
+    import arcpy
+    outSR = arcpy.env.outputCoordinateSystem or demSR
+    counts = {}
+    batch = {}
+    for interval, savefile in outputs.items():
+        arcpy.management.CreateFeatureclass(os.path.dirname(savefile), os.path.basename(savefile), "POLYLINE", None, "DISABLED", "ENABLED", outSR)
+        if "Id" not in [field.name for field in arcpy.ListFields(savefile)]:
+            arcpy.management.AddField(savefile, "Id", "LONG")
+        arcpy.management.AddField(savefile, "Contour", "DOUBLE")
+        counts[interval] = 0
+        batch[interval] = []
+
+    workspace = os.path.dirname(next(iter(outputs.values())))
+    inGeodatabase = arcpy.Describe(workspace).workspaceType != "FileSystem"
+    buffered = 0
+    for elevation, line in lines:
+        targets = [interval for interval in outputs if onInterval(elevation, interval)]
+        if not targets:
+            continue
+        polyline = line if isinstance(line, arcpy.Geometry) else arcpy.Polyline(arcpy.Array([arcpy.Point(x, y, elevation) for x, y in line]), demSR, True)
+        for interval in targets:
+            counts[interval] += 1
+            batch[interval].append([polyline, counts[interval], elevation])
+        buffered += 1
+        if buffered >= batchSize:
+            flushContours(batch, outputs, workspace, inGeodatabase)
+            buffered = 0
+    flushContours(batch, outputs, workspace, inGeodatabase)
+    return counts
+
+
+def flushContours(batch, outputs, workspace, inGeodatabase):
+    # One edit operation (in a geodatabase) and one cursor per output for the whole batch
+    import arcpy
+    with arcpy.da.Editor(workspace) if inGeodatabase else contextlib.nullcontext():
+        for interval, rows in batch.items():
+            if rows:
+                with arcpy.da.InsertCursor(outputs[interval], ["Shape@", "Id", "Contour"]) as cursor:
+                    for row in rows:
+                        cursor.insertRow(row)
+                rows.clear()
+
 
 # This is used to execute code if the file was run but not imported
 if __name__ == '__main__':
+    import arcpy
 
     # Tool parameter accessed with GetParameter or GetParameterAsText
     inputDEM = arcpy.GetParameterAsText(0)
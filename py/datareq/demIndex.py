@@ -0,0 +1,272 @@
+'''
+In-memory spatial index of the 1m DEM coverage index
+The coverage shapefile is packed once into a sort-tile-recursive (STR) R-tree and saved to a compact
+binary sidecar next to it, so tools can find the tiles under an AOI without a geoprocessing round trip:
+a bbox search down the tree, then an exact polygon test against the candidate footprints
+The sidecar is rebuilt automatically whenever the shapefile changes
+'''
+
+import os
+import math
+import tempfile
+import struct
+import numpy as np
+
+nodeCapacity = 16
+sidecarMagic = b"DEMSTR1\0"
+sidecarHeader = "<8sdqiiiii"     # magic, source mtime, source size, features, rings, coords, levels, capacity
+
+
+class DEMIndex:
+    def __init__(self, levels, ringStart, coordStart, coords, records, spatialReferenceWKT, capacity=nodeCapacity):
+        self.levels = levels            # bbox arrays (n, 4) from the leaves (one entry per feature, in tree order) up to the root
+        self.ringStart = ringStart      # feature i owns rings ringStart[i]:ringStart[i + 1]
+        self.coordStart = coordStart    # ring j owns coords coordStart[j]:coordStart[j + 1]
+        self.coords = coords            # (n, 2) ring vertices, closed
+        self.records = records          # (featureId, project, linkaws) per leaf entry, in tree order
+        self.spatialReferenceWKT = spatialReferenceWKT
+        self.capacity = capacity
+
+        # Flat edge list (as the index of each edge's first vertex), grouped by leaf entry, so the exact test can
+        # check every candidate in one go
+        isEdge = np.ones(max(len(coords) - 1, 0), dtype=bool)
+        isEdge[coordStart[1:-1] - 1] = False
+        self.edgeStarts = np.flatnonzero(isEdge)
+        self.entryEdgeStart = np.searchsorted(self.edgeStarts, coordStart[ringStart])
+
+    @classmethod
+    def load(cls, shapefile, fields=("project", "linkaws"), sidecar=None):
+        # Load the packed index for shapefile, (re)building the sidecar first if it is missing or out of date
+        sidecar = sidecar or os.path.splitext(shapefile)[0] + ".strtree"
+        stat = os.stat(shapefile)
+        if os.path.exists(sidecar):
+            index = cls.read(sidecar, (stat.st_mtime, stat.st_size))
+            if index is not None:
+                return index
+        index = cls.build(shapefile, fields)
+        index.write(sidecar, (stat.st_mtime, stat.st_size))
+        return index
+
+    @classmethod
+    def build(cls, shapefile, fields=("project", "linkaws")):
+        # Needs arcpy to read the shapefile; everything else in here is plain NumPy
+        import arcpy
+        spatialReference = arcpy.Describe(shapefile).spatialReference
+        features = []
+        with arcpy.da.SearchCursor(shapefile, ["OID@", "Shape@"] + list(fields)) as cursor:
+            for oid, shape, project, link in cursor:
+                if shape is not None:
+                    features.append((oid, project, link, geometryRings(shape)))
+        return cls.pack(features, spatialReference.exportToString())
+
+    @classmethod
+    def pack(cls, features, spatialReferenceWKT, capacity=nodeCapacity):
+        # features is a list of (featureId, project, linkaws, rings); rings are lists of (x, y)
+        boxes = np.array([ringsBounds(rings) for _, _, _, rings in features], dtype=float).reshape(-1, 4)
+        order = strOrder(boxes, capacity)
+        levels = [boxes[order]]
+        while len(levels[-1]) > 1:
+            levels.append(parentBoxes(levels[-1], capacity))
+
+        ringStart = [0]
+        coordStart = [0]
+        coords = []
+        records = []
+        for i in order:
+            featureId, project, link, rings = features[i]
+            records.append((featureId, project, link))
+            for ring in rings:
+                coords.extend(ring)
+                coordStart.append(len(coords))
+            ringStart.append(len(coordStart) - 1)
+        return cls(levels, np.array(ringStart, dtype=np.int32), np.array(coordStart, dtype=np.int32),
+                   np.array(coords, dtype=float).reshape(-1, 2), records, spatialReferenceWKT, capacity)
+
+    def write(self, sidecar, sourceStamp):
+        strings = "\n".join(f"{featureId}\t{project}\t{link}" for featureId, project, link in self.records).encode("utf-8")
+        wkt = self.spatialReferenceWKT.encode("utf-8")
+        # Written under a temp name of its own (several users may rebuild the same sidecar at once) and renamed into place
+        fd, tempPath = tempfile.mkstemp(prefix=os.path.basename(sidecar) + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(sidecar)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(struct.pack(sidecarHeader, sidecarMagic, sourceStamp[0], sourceStamp[1], len(self.records),
+                                    len(self.coordStart) - 1, len(self.coords), len(self.levels), self.capacity))
+                f.write(np.array([len(level) for level in self.levels], dtype="<i4").tobytes())
+                for level in self.levels:
+                    f.write(level.astype("<f8").tobytes())
+                f.write(self.ringStart.astype("<i4").tobytes())
+                f.write(self.coordStart.astype("<i4").tobytes())
+                f.write(self.coords.astype("<f8").tobytes())
+                f.write(struct.pack("<qq", len(strings), len(wkt)))
+                f.write(strings)
+                f.write(wkt)
+            try:
+                os.replace(tempPath, sidecar)
+            except PermissionError:
+                # Windows won't replace a sidecar another run has open; it is rebuilt again next time if out of date
+                if not os.path.exists(sidecar):
+                    raise
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+    @classmethod
+    def read(cls, sidecar, sourceStamp=None):
+        # Returns None if the sidecar is unreadable or was built from a different version of the shapefile
+        with open(sidecar, "rb") as f:
+            data = f.read()
+        headerSize = struct.calcsize(sidecarHeader)
+        if len(data) < headerSize:
+            return None
+        magic, mtime, size, nFeatures, nRings, nCoords, nLevels, capacity = struct.unpack_from(sidecarHeader, data)
+        if magic != sidecarMagic or (sourceStamp is not None and (mtime, size) != tuple(sourceStamp)):
+            return None
+
+        offset = headerSize
+
+        def take(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        levelSizes = take("<i4", nLevels)
+        levels = [take("<f8", int(n) * 4).reshape(-1, 4) for n in levelSizes]
+        ringStart = take("<i4", nFeatures + 1)
+        coordStart = take("<i4", nRings + 1)
+        coords = take("<f8", nCoords * 2).reshape(-1, 2)
+        stringsLength, wktLength = struct.unpack_from("<qq", data, offset)
+        offset += 16
+        strings = data[offset:offset + stringsLength].decode("utf-8")
+        wkt = data[offset + stringsLength:offset + stringsLength + wktLength].decode("utf-8")
+        records = []
+        for line in strings.split("\n") if strings else []:
+            featureId, project, link = line.split("\t")
+            records.append((int(featureId), project, link))
+        return cls(levels, ringStart, coordStart, coords, records, wkt, capacity)
+
+    def search(self, bounds):
+        # Leaf entries whose bbox overlaps bounds (xmin, ymin, xmax, ymax), walking down the tree a level at a time
+        if not self.records:
+            return np.zeros(0, dtype=int)
+        xmin, ymin, xmax, ymax = bounds
+        nodes = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[depth][nodes]
+            nodes = nodes[(boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)]
+            if depth > 0:
+                children = (nodes[:, None] * self.capacity + np.arange(self.capacity)).ravel()
+                nodes = children[children < len(self.levels[depth - 1])]
+        return nodes
+
+    def featureRings(self, entry):
+        return [self.coords[self.coordStart[j]:self.coordStart[j + 1]] for j in range(self.ringStart[entry], self.ringStart[entry + 1])]
+
+    def intersecting(self, aoiRings):
+        # (featureId, project, linkaws) of every footprint that intersects the AOI polygon, in feature id order
+        # aoiRings must be in the index's coordinate system
+        return sorted(self.records[entry] for entry in self.intersectingEntries(aoiRings))
+
+    def intersectingFootprints(self, aoiRings):
+        # As intersecting, but (featureId, project, linkaws, rings), with each footprint's rings as (n, 2) arrays
+        return sorted((self.records[entry] + (self.featureRings(entry),) for entry in self.intersectingEntries(aoiRings)), key=lambda hit: hit[0])
+
+    def intersectingEntries(self, aoiRings):
+        # Leaf entries (tree order) whose footprints intersect the AOI polygon
+        aoiRings = [np.asarray(ring, dtype=float) for ring in aoiRings if len(ring) > 1]
+        if not aoiRings:
+            return np.zeros(0, dtype=int)
+        entries = self.search(ringsBounds(aoiRings))
+        if len(entries) == 0:
+            return entries
+
+        # Edges of all the candidates, and which candidate each belongs to
+        starts = self.entryEdgeStart[entries]
+        counts = self.entryEdgeStart[entries + 1] - starts
+        owner = np.repeat(np.arange(len(entries)), counts)
+        edgeIds = self.edgeStarts[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        candidateEdges = np.hstack([self.coords[edgeIds], self.coords[edgeIds + 1]])
+        aoiEdges = ringEdges(aoiRings)
+
+        # A candidate hits if its boundary touches the AOI's, if it contains any part of the AOI (a vertex of
+        # every ring is tested, so each part of a multipart AOI counts), or if the AOI contains it
+        hit = np.bincount(owner, weights=edgesCross(candidateEdges, aoiEdges).any(axis=1), minlength=len(entries)) > 0
+        for crossings in rayCrossings(np.array([ring[0] for ring in aoiRings]), candidateEdges):
+            hit |= np.bincount(owner, weights=crossings, minlength=len(entries)) % 2 == 1
+        firstVertices = self.coords[self.coordStart[self.ringStart[entries]]]
+        hit |= np.count_nonzero(rayCrossings(firstVertices, aoiEdges), axis=-1) % 2 == 1
+        return entries[hit]
+
+
+def geometryRings(polygon):
+    # Rings of an arcpy Polygon as lists of (x, y); interior rings come after a None in each part
+    rings = []
+    for part in polygon:
+        ring = []
+        for point in part:
+            if point is None:
+                if ring:
+                    rings.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if ring:
+            rings.append(ring)
+    return [ring if ring[0] == ring[-1] else ring + [ring[0]] for ring in rings]
+
+
+def ringsBounds(rings):
+    allCoords = np.vstack([np.asarray(ring, dtype=float) for ring in rings]) if len(rings) else np.zeros((1, 2))
+    return allCoords[:, 0].min(), allCoords[:, 1].min(), allCoords[:, 0].max(), allCoords[:, 1].max()
+
+
+def strOrder(boxes, capacity):
+    # Sort-tile-recursive packing: vertical slices by x centre, then by y centre within each slice
+    n = len(boxes)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+    sliceCount = math.ceil(math.sqrt(math.ceil(n / capacity)))
+    sliceSize = sliceCount * capacity
+    byX = np.argsort(centres[:, 0], kind="stable")
+    order = []
+    for start in range(0, n, sliceSize):
+        chunk = byX[start:start + sliceSize]
+        order.append(chunk[np.argsort(centres[chunk, 1], kind="stable")])
+    return np.concatenate(order)
+
+
+def parentBoxes(boxes, capacity):
+    # Union of each consecutive group of capacity boxes
+    groups = math.ceil(len(boxes) / capacity)
+    padded = np.vstack([boxes, np.repeat(boxes[-1:], groups * capacity - len(boxes), axis=0)]).reshape(groups, capacity, 4)
+    return np.column_stack([padded[:, :, 0].min(axis=1), padded[:, :, 1].min(axis=1), padded[:, :, 2].max(axis=1), padded[:, :, 3].max(axis=1)])
+
+
+def ringEdges(rings):
+    return np.vstack([np.hstack([ring[:-1], ring[1:]]) for ring in rings if len(ring) > 1])
+
+
+def edgesCross(a, b):
+    # (len(a), len(b)) matrix of which edges cross; touching and collinear overlaps count as crossing
+    ax0, ay0, ax1, ay1 = (a[:, i][:, None] for i in range(4))
+    bx0, by0, bx1, by1 = (b[:, i][None, :] for i in range(4))
+    boxesOverlap = (np.minimum(ax0, ax1) <= np.maximum(bx0, bx1)) & (np.minimum(bx0, bx1) <= np.maximum(ax0, ax1)) & \
+                   (np.minimum(ay0, ay1) <= np.maximum(by0, by1)) & (np.minimum(by0, by1) <= np.maximum(ay0, ay1))
+    d1 = (ax1 - ax0) * (by0 - ay0) - (ay1 - ay0) * (bx0 - ax0)
+    d2 = (ax1 - ax0) * (by1 - ay0) - (ay1 - ay0) * (bx1 - ax0)
+    d3 = (bx1 - bx0) * (ay0 - by0) - (by1 - by0) * (ax0 - bx0)
+    d4 = (bx1 - bx0) * (ay1 - by0) - (by1 - by0) * (ax1 - bx0)
+    return boxesOverlap & (d1 * d2 <= 0) & (d3 * d4 <= 0)
+
+
+def rayCrossings(points, edges):
+    # Per edge, whether a ray from the point towards +x crosses it (odd total = inside, by the even-odd rule)
+    # For an array of points this is a (points, edges) matrix
+    points = np.asarray(points, dtype=float)
+    x, y = points[..., 0, None], points[..., 1, None]
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xCross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return crosses & (x < xCross)
@@ -0,0 +1,280 @@
+'''
+Shared HTTP download engine for the DEM tools
+Keeps a single urllib3 connection pool for the whole run, so connections are reused from tile to tile,
+and runs a bounded number of downloads at once with a cap on simultaneous connections to each host
+Downloads go to a .part file that is resumed with a Range request if the connection drops, are checked
+against the expected length (and the MD5 ETag when the server gives one) and retried with jittered backoff
+'''
+
+import os
+import re
+import json
+import random
+import hashlib
+import threading
+import time
+import urllib3
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+defaultWorkers = 8          # downloads running at the same time
+defaultPerHostLimit = 4     # connections open to any single host (USGS and AWS both throttle greedy clients)
+defaultMaxPending = 16      # downloaded-but-not-yet-processed files allowed to pile up on disk
+chunkSize = 1024 * 1024     # bytes written per read when streaming a download to disk
+maxRetries = 6              # attempts after the first, for dropped connections, 5xx/429 and bad downloads
+backoffBase = 1.0           # seconds; the wait before retry n is random between 0 and backoffBase * 2^n
+backoffCap = 60.0           # longest wait between retries, in seconds
+verifyMD5 = True            # check downloads against the ETag when it is a plain MD5 (ie. single-part S3 uploads)
+requestTimeout = urllib3.Timeout(connect=30, read=120)
+retryStatuses = (429, 500, 502, 503, 504)
+
+
+class DownloadIntegrityError(IOError):
+    # The body that arrived doesn't match what the server said it would be
+    pass
+
+
+class DownloadEngine:
+    def __init__(self, workers=defaultWorkers, perHostLimit=defaultPerHostLimit, hostLimits=None):
+        # hostLimits overrides perHostLimit for particular hosts, ie. {"rockyweb.usgs.gov": 2}
+        self.workers = workers
+        self.perHostLimit = perHostLimit
+        self.hostLimits = hostLimits or {}
+        # One pool for everything; block=True makes extra requests wait for a free connection instead of opening more
+        self.http = urllib3.PoolManager(num_pools=16, maxsize=max([perHostLimit] + list(self.hostLimits.values())), block=True, timeout=requestTimeout)
+        self._hostSemaphores = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.http.clear()
+
+    def _hostSemaphore(self, url):
+        host = urlsplit(url).hostname
+        with self._lock:
+            if host not in self._hostSemaphores:
+                self._hostSemaphores[host] = threading.BoundedSemaphore(self.hostLimits.get(host, self.perHostLimit))
+            return self._hostSemaphores[host]
+
+    def get(self, url, headers=None):
+        # Small requests (ie. directory listings) that are read straight into memory
+        with self._hostSemaphore(url):
+            return self.http.request('GET', url, headers=headers)
+
+    def head(self, url):
+        # Response headers for url (ie. ETag and Content-Length), without the body
+        with self._hostSemaphore(url):
+            r = self.http.request('HEAD', url)
+        if r.status != 200:
+            raise IOError(f"ERROR reaching {url} (HTTP {r.status})")
+        return r.headers
+
+    def getRange(self, url, start, length):
+        # Read length bytes from start via an HTTP Range request; servers that ignore Range send the whole file
+        r = self.get(url, headers={"Range": f"bytes={start}-{start + length - 1}"})
+        if r.status == 206:
+            return r.data
+        if r.status == 200:
+            return r.data[start:start + length]
+        raise IOError(f"ERROR reaching {url} (HTTP {r.status})")
+
+    def download(self, url, savePath, progress=None):
+        # Download url to savePath, via savePath.part, resuming and retrying as needed; raises if it can't be done
+        # progress, if given, is called with the number of bytes in each chunk written (negative if a part is thrown away)
+        partPath = savePath + ".part"
+        for attempt in range(maxRetries + 1):
+            try:
+                self._downloadPart(url, partPath, progress)
+                break
+            except (urllib3.exceptions.HTTPError, ConnectionError, DownloadIntegrityError, RetryableStatus) as e:
+                if attempt == maxRetries:
+                    raise IOError(f"ERROR downloading {url} after {attempt + 1} attempts: {e}")
+                time.sleep(random.uniform(0, min(backoffCap, backoffBase * 2 ** attempt)))
+        os.replace(partPath, savePath)
+        _removeIfExists(partPath + ".json")
+        return savePath
+
+    def _downloadPart(self, url, partPath, progress):
+        # One attempt: carry on from whatever is already in partPath if the server still has the same file
+        metaPath = partPath + ".json"
+        have = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        meta = _readMeta(metaPath) if have else {}
+        headers = {}
+        if have and meta.get("validator"):
+            headers["Range"] = f"bytes={have}-"
+            headers["If-Range"] = meta["validator"]     # server sends the whole file instead if it has changed
+
+        with self._hostSemaphore(url):
+            with self.http.request('GET', url, headers=headers, preload_content=False, retries=False) as resp:
+                if resp.status in retryStatuses:
+                    resp.drain_conn()
+                    raise RetryableStatus(f"HTTP {resp.status}")
+                if resp.status == 416:
+                    # Nothing left to send; the part is either complete or junk
+                    resp.drain_conn()
+                    total = _contentRangeTotal(resp.headers.get("Content-Range"))
+                    if total is not None and total == have:
+                        self._verify(url, partPath, total, meta.get("validator"), progress)
+                        return
+                    _discard(partPath, have, progress)
+                    raise DownloadIntegrityError("server refused to resume the partial file")
+                if resp.status == 206:
+                    start = _contentRangeStart(resp.headers.get("Content-Range"))
+                    if start != have:
+                        resp.drain_conn()
+                        _discard(partPath, have, progress)
+                        raise DownloadIntegrityError("server resumed from the wrong place")
+                    total = _contentRangeTotal(resp.headers.get("Content-Range"))
+                    mode = 'ab'
+                elif resp.status == 200:
+                    if have:
+                        _discard(partPath, have, progress)
+                    have = 0
+                    total = int(resp.headers["Content-Length"]) if resp.headers.get("Content-Length") else None
+                    mode = 'wb'
+                else:
+                    resp.drain_conn()
+                    raise IOError(f"ERROR reaching {url} (HTTP {resp.status})")
+
+                # Remember what we are downloading, so a later attempt (or run) can resume it safely
+                validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                if mode == 'wb' or not meta:
+                    meta = {"validator": validator, "total": total}
+                    with open(metaPath, 'w') as f:
+                        json.dump(meta, f)
+
+                with open(partPath, mode) as out_file:
+                    for chunk in resp.stream(chunkSize):
+                        out_file.write(chunk)
+                        if progress is not None:
+                            progress(len(chunk))
+                resp.release_conn()
+
+        self._verify(url, partPath, total or meta.get("total"), meta.get("validator"), progress)
+
+    def _verify(self, url, partPath, total, validator, progress=None):
+        # A short file is kept so the next attempt resumes it; anything else wrong means starting over
+        size = os.path.getsize(partPath)
+        if total is not None and size < total:
+            raise DownloadIntegrityError(f"got {size} of {total} bytes")
+        if total is not None and size > total:
+            _discard(partPath, size, progress)
+            raise DownloadIntegrityError(f"got {size} bytes, expected {total}")
+        md5 = (validator or "").strip('"')
+        if verifyMD5 and re.fullmatch(r"[0-9a-f]{32}", md5):
+            digest = hashlib.md5()
+            with open(partPath, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunkSize), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() != md5:
+                _discard(partPath, size, progress)
+                raise DownloadIntegrityError(f"MD5 mismatch for {url}")
+
+    def submit(self, fn, *args):
+        # Run fn(*args) on one of the download threads
+        return self._executor.submit(fn, *args)
+
+    def runAll(self, fn, jobs, maxPending=defaultMaxPending):
+        # jobs is an iterable of (args, tag); runs fn(*args) for each on the worker threads and yields
+        # (tag, result, error) as each one finishes
+        # Only maxPending jobs are queued or waiting to be consumed at once, so the caller can work on
+        # finished results while the next ones are still running, without racing too far ahead
+        jobs = iter(jobs)
+        pending = {}
+
+        def fill():
+            while len(pending) < maxPending:
+                try:
+                    args, tag = next(jobs)
+                except StopIteration:
+                    return
+                pending[self._executor.submit(fn, *args)] = tag
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tag = pending.pop(future)
+                error = future.exception()
+                yield tag, (future.result() if error is None else None), error
+            fill()
+
+    def downloadAll(self, jobs, maxPending=defaultMaxPending):
+        # jobs is an iterable of (url, savePath, tag); yields (tag, savePath, error) as each download finishes
+        # Caps files on disk waiting to be processed at maxPending; a failed download leaves its .part behind,
+        # so running again picks up where it stopped
+        for (tag, savePath), _, error in self.runAll(self.download, (((url, savePath), (tag, savePath)) for url, savePath, tag in jobs), maxPending):
+            if error is not None and os.path.exists(savePath):
+                os.remove(savePath)
+            yield tag, savePath, error
+
+
+class RetryableStatus(IOError):
+    pass
+
+
+def _readMeta(metaPath):
+    try:
+        with open(metaPath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _removeIfExists(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _discard(partPath, have, progress):
+    # Throw away a partial download that can't be resumed
+    _removeIfExists(partPath)
+    _removeIfExists(partPath + ".json")
+    if progress is not None and have:
+        progress(-have)
+
+
+def _contentRangeStart(contentRange):
+    match = re.match(r"bytes (\d+)-", contentRange or "")
+    return int(match.group(1)) if match else None
+
+
+def _contentRangeTotal(contentRange):
+    match = re.search(r"/(\d+)$", contentRange or "")
+    return int(match.group(1)) if match else None
+
+
+class DownloadProgress:
+    # Running byte counts across all the downloads of a run, updated from the download threads
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self.expectedBytes = 0
+        self.doneBytes = 0
+
+    def expect(self, nBytes):
+        with self._lock:
+            self.expectedBytes += nBytes
+
+    def add(self, nBytes):
+        with self._lock:
+            self.doneBytes += nBytes
+
+    def fraction(self):
+        return min(1.0, self.doneBytes / self.expectedBytes) if self.expectedBytes else 0.0
+
+    def describe(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        rate = self.doneBytes / elapsed
+        text = f"{self.doneBytes / 1024 ** 2:,.0f} of {self.expectedBytes / 1024 ** 2:,.0f} MB at {rate / 1024 ** 2:,.1f} MB/s"
+        if rate > 0 and self.expectedBytes > self.doneBytes:
+            remaining = int((self.expectedBytes - self.doneBytes) / rate)
+            text += f", about {remaining // 60}m {remaining % 60:02d}s left"
+        return text
@@ -1,13 +1,34 @@
 defaultDEMindex = "indices/1m_usgs_dem_coverage.shp"
 coverageFields = ["project", "linkaws"]       # the fields housing project name and DEM link in the index
+sizeFields = ["bytes", "ncols", "nrows"]      # per-DEM download size and pixel dimensions in the index, for estimates
+maxJobBytes = None                            # refuse jobs that would download more than this many bytes (None = no limit)
+useSpatialIndex = True                        # look up tiles in the packed in-memory index (sidecar next to the shapefile)
+                                              # instead of SelectLayerByLocation
+tileCacheDir = None                           # where downloaded DEMs are kept between runs (None = per-user default)
+tileCacheBytes = 50 * 1024 ** 3               # size the tile cache is trimmed back to (least recently used go first)
+downloadWorkers = 6                           # DEMs downloading at the same time
+windowedReads = False                         # read just the AOI window of each DEM with HTTP range requests (GDAL /vsicurl/)
+                                              # instead of downloading whole tiles; best for small AOIs
+tileSelection = "newest"                      # where projects overlap, only fetch the tiles needed to cover the AOI (spatial index only):
+                                              # "newest" prefers the newest project, "index" the index order, or give a list
+                                              # of project names in order of preference; "all" fetches every intersecting tile
+mosaicMethod = "vrt"                          # "vrt": virtual mosaic of the tiles, warped block by block straight into the clipped output
+                                              # "merge": arcpy.ia.Merge of the whole tiles, then Clip (the original method)
 
 import arcpy
-import urllib3
 import os
-import shutil
+import time
+from osgeo import gdal, ogr, osr
 from buildContours import buildContours
+from concurrent.futures import wait
+from downloader import DownloadEngine, DownloadProgress
+from tileCache import TileCache
+from demIndex import DEMIndex, geometryRings
+from tileSelection import selectTiles
+from runHistory import RunHistory, formatDuration
  
-def fetchDEM(boundaryFC, outDir, outFilename):
+def fetchDEM(boundaryFC, outDir, outFilename, dryRun=False):
+    # With dryRun, only reports what the job would download and how long it should take
 
     # Check 1m DEM Index
     if arcpy.Exists(defaultDEMindex):
@@ -18,64 +39,69 @@ def fetchDEM(boundaryFC, outDir, outFilename):
 
     # Compare boundaryFC to DEM Index to see what DEMs need fetching
     arcpy.SetProgressor("default", f"Checking for DEMs which intersect the AOI...")
-    intersectingDems = arcpy.SelectLayerByLocation_management(defaultDEMindex, 'INTERSECT', boundaryFC)
-    demCount = int(arcpy.management.GetCount(intersectingDems)[0]) # convert Result object to int (via str)
+    if useSpatialIndex:
+        demLinks = [link for _, _, link in indexedDEMs(boundaryFC)]
+    else:
+        intersectingDems = arcpy.SelectLayerByLocation_management(defaultDEMindex, 'INTERSECT', boundaryFC)
+        with arcpy.da.SearchCursor(intersectingDems, coverageFields) as cursor:
+            demLinks = [row[1] for row in cursor]
+    demCount = len(demLinks)
     if demCount > 0:
         arcpy.AddMessage(f"{demCount} DEMs intersect the AOI")
     else:
         arcpy.AddError("No DEMs in the index file intersect your AOI! Check the index to see the coverage area")
     
-    # Fetch all DEMs
-    demList = []
-    arcpy.AddMessage(f"\nDownloading Intersecting DEMs, please wait...")
-    with arcpy.da.SearchCursor(intersectingDems, coverageFields) as cursor:
-        for row in cursor:
-            httpPath = row[1]
-            basename = os.path.basename(httpPath)
-            savePath = os.path.join(arcpy.env.scratchFolder, basename) # get rid of underscores for the DB
-
-            arcpy.AddMessage(f"Downloading {httpPath} to {arcpy.env.scratchFolder}")
-            arcpy.SetProgressor("default", f"Downloading {basename}")
-
-            http = urllib3.PoolManager()
-            with http.request('GET', httpPath, preload_content=False) as resp, open(savePath, 'wb') as out_file:
-                if resp.status != 200:
-                    arcpy.AddError(f"ERROR reaching {httpPath}")
-                else:
-                    # Save the output file
-                    shutil.copyfileobj(resp, out_file)
-            
-            demList.append(savePath)
-
-            # Add temp DEMs to map (don't do this now bc they are removed at end of script; kept in case needed for testing)
-            # aprx = arcpy.mp.ArcGISProject("CURRENT")
-            # aprx.activeMap.addDataFromPath(savePath)
-
-    # Merge if there is more than one DEM
-    if demCount > 1:
-        arcpy.SetProgressor("default", f"Merging multiple rasters...")
-        arcpy.AddMessage("Merging multiple rasters...")
-        mergeRaster = arcpy.ia.Merge(demList, "FIRST")
+    cache = TileCache(tileCacheDir, tileCacheBytes)
+    savefile = os.path.join(outDir, outFilename)
+
+    # Size up the job before starting it (the server is only asked for sizes the index lacks when the number is used)
+    history = RunHistory()
+    estimate = estimateJob(demLinks, cache, history, askServer=dryRun or maxJobBytes is not None)
+    arcpy.AddMessage(describeEstimate(estimate))
+    if dryRun:
+        arcpy.AddMessage("Dry run; nothing was downloaded")
+        return None
+    if maxJobBytes is not None and estimate["downloadBytes"] > maxJobBytes:
+        arcpy.AddError(f"This job would download {estimate['downloadBytes'] / 1024 ** 3:,.1f} GB, more than the {maxJobBytes / 1024 ** 3:,.1f} GB limit; try a smaller AOI")
+        return None
+
+    if windowedReads:
+        # Only the blocks of each DEM that fall in the AOI come over the network
+        arcpy.AddMessage(f"\nReading the AOI window of each intersecting DEM, please wait...")
+        demList = remoteSources(demLinks, cache)
+        arcpy.AddMessage(cache.summary())
     else:
-        mergeRaster = demList[0]
+        demList = downloadDEMs(demLinks, cache)
 
-    # Clip DEM to boundaryFC
-    arcpy.SetProgressor("default", f"Clipping raster to area of interest...")
-    arcpy.AddMessage("Clipping raster to area of interest...")
-    savefile = os.path.join(outDir, outFilename)
-    # outRaster = os.path.join(arcpy.env.scratchWorkspace, "out_raster")
-    arcpy.management.Clip(mergeRaster, "", savefile, boundaryFC, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+    mosaicStart = time.time()
+    if mosaicMethod == "merge" and not windowedReads:
+        # Merge if there is more than one DEM
+        if len(demList) > 1:
+            arcpy.SetProgressor("default", f"Merging multiple rasters...")
+            arcpy.AddMessage("Merging multiple rasters...")
+            mergeRaster = arcpy.ia.Merge(demList, "FIRST")
+        else:
+            mergeRaster = demList[0]
+
+        # Clip DEM to boundaryFC
+        arcpy.SetProgressor("default", f"Clipping raster to area of interest...")
+        arcpy.AddMessage("Clipping raster to area of interest...")
+        # outRaster = os.path.join(arcpy.env.scratchWorkspace, "out_raster")
+        arcpy.management.Clip(mergeRaster, "", savefile, boundaryFC, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+    else:
+        # Mosaic and clip in one streaming pass; nothing outside the AOI is written anywhere
+        arcpy.SetProgressor("default", f"Mosaicking and clipping to area of interest...")
+        arcpy.AddMessage("Mosaicking and clipping to area of interest...")
+        clipMosaic(demList, boundaryFC, savefile)
+    if not windowedReads:
+        history.record("mosaic", estimate["cells"], time.time() - mosaicStart)
 
     # Add DEM to map
     aprx = arcpy.mp.ArcGISProject("CURRENT")
     aprx.activeMap.addDataFromPath(savefile)
 
-    # Remove files created in arcpy.env.scratchFolder (they are not automatically deleted)
-    arcpy.SetProgressor("default", "Removing temporary files...")
-    arcpy.AddMessage("Removing temporary files...")
-    for tempFile in demList:
-        arcpy.management.Delete(tempFile)
-    
+    # Downloaded DEMs stay in the tile cache for the next run
+
 
     arcpy.AddMessage("Success!")
 
@@ -83,6 +109,204 @@ def fetchDEM(boundaryFC, outDir, outFilename):
     return savefile
 
 
+def indexedDEMs(boundaryFC):
+    # (featureId, project, link) of the indexed DEMs needed to cover the AOI polygons, in merge order
+    index = DEMIndex.load(defaultDEMindex, coverageFields)
+    sr = arcpy.SpatialReference()
+    sr.loadFromString(index.spatialReferenceWKT)
+    candidates = {}
+    aoiRings = []
+    with arcpy.da.SearchCursor(boundaryFC, ["Shape@"], spatial_reference=sr) as cursor:
+        for row in cursor:
+            if row[0] is not None:
+                rings = geometryRings(row[0])
+                aoiRings.append(rings)
+                for footprint in index.intersectingFootprints(rings):
+                    candidates[footprint[0]] = footprint
+    selected = selectTiles(candidates.values(), aoiRings, tileSelection, index.spatialReferenceWKT)
+    if len(selected) < len(candidates):
+        projects = sorted({project for _, project, _ in selected})
+        arcpy.AddMessage(f"{len(selected)} of the {len(candidates)} intersecting DEMs cover the AOI (from {', '.join(projects)})")
+    return selected
+
+
+def downloadDEMs(demLinks, cache):
+    # Fetch all DEMs (from the tile cache where possible), several at once over one connection pool
+    # Keeps the index order, which the "FIRST" merge relies on
+    tiles = fetchTiles(demLinks, cache)
+    return [tiles[httpPath] for httpPath in demLinks if httpPath in tiles]
+
+
+def fetchTiles(demLinks, cache):
+    # {link: local path} of every DEM that could be fetched; failures are reported and left out
+    tiles = {}
+    progress = DownloadProgress()
+    start = time.time()
+    bytesBefore, missesBefore = cache.bytesDownloaded, cache.misses
+    arcpy.AddMessage(f"\nDownloading Intersecting DEMs, please wait...")
+    arcpy.SetProgressor("step", f"Downloading {len(demLinks)} DEMs...", 0, 100, 1)
+    with DownloadEngine(downloadWorkers, perHostLimit=downloadWorkers) as engine:
+        futures = [engine.submit(cache.fetch, engine, httpPath, progress) for httpPath in demLinks]
+
+        # Update the progressor from this thread (arcpy doesn't like being called from the download threads)
+        while True:
+            done, notDone = wait(futures, timeout=1)
+            arcpy.SetProgressorPosition(int(progress.fraction() * 100))
+            arcpy.SetProgressorLabel(f"Downloaded {len(done)}/{len(futures)} DEMs: {progress.describe()}")
+            if not notDone:
+                break
+
+    for httpPath, future in zip(demLinks, futures):
+        if future.exception() is not None:
+            arcpy.AddError(str(future.exception()))
+        else:
+            arcpy.AddMessage(f"Fetched {httpPath}")
+            tiles[httpPath] = future.result()
+    arcpy.AddMessage(f"Downloaded {progress.describe()}")
+    if cache.misses > missesBefore:
+        RunHistory().record("download", cache.bytesDownloaded - bytesBefore, time.time() - start)
+    arcpy.AddMessage(cache.summary())
+    arcpy.ResetProgressor()
+
+    return tiles
+
+
+def estimateJob(demLinks, cache, history, askServer=True):
+    # Size of the job from the index and the tile cache, and how long it should take going by recent runs
+    # With askServer, DEMs the index has no size for are sized with a HEAD request each; otherwise they count as 0
+    sizes = indexedSizes(demLinks)
+    missing = [httpPath for httpPath in demLinks if httpPath not in sizes]
+    if missing and askServer:
+        # Index built before sizes were recorded; the server knows
+        with DownloadEngine(downloadWorkers, perHostLimit=downloadWorkers) as engine:
+            futures = [engine.submit(engine.head, httpPath) for httpPath in missing]
+            for httpPath, future in zip(missing, futures):
+                headers = future.result() if future.exception() is None else {}
+                sizes[httpPath] = (int(headers.get("Content-Length") or 0), 0, 0)
+
+    estimate = {"tiles": len(demLinks), "bytes": 0, "cells": 0, "cachedTiles": 0, "downloadBytes": 0, "unsizedTiles": 0}
+    for httpPath in demLinks:
+        if httpPath not in sizes:
+            estimate["unsizedTiles"] += 1
+        nBytes, ncols, nrows = sizes.get(httpPath, (0, 0, 0))
+        estimate["bytes"] += nBytes
+        estimate["cells"] += ncols * nrows
+        if cache.peek(httpPath) is not None:
+            estimate["cachedTiles"] += 1
+        else:
+            estimate["downloadBytes"] += nBytes
+    estimate["seconds"] = history.estimate("download", estimate["downloadBytes"]) + history.estimate("mosaic", estimate["cells"])
+    return estimate
+
+
+def indexedSizes(demLinks):
+    # {link: (bytes, ncols, nrows)} from the index, for the DEMs it has sizes for
+    if not all(field in [f.name for f in arcpy.ListFields(defaultDEMindex)] for field in sizeFields):
+        return {}
+    wanted = set(demLinks)
+    sizes = {}
+    with arcpy.da.SearchCursor(defaultDEMindex, [coverageFields[1]] + sizeFields) as cursor:
+        for httpPath, nBytes, ncols, nrows in cursor:
+            if httpPath in wanted and nBytes:
+                sizes[httpPath] = (int(nBytes), int(ncols or 0), int(nrows or 0))
+    return sizes
+
+
+def describeEstimate(estimate):
+    text = (f"Estimate: {estimate['tiles']} DEMs, {estimate['bytes'] / 1024 ** 3:,.2f} GB "
+            f"({estimate['cachedTiles']} already in the tile cache, {estimate['downloadBytes'] / 1024 ** 3:,.2f} GB to download), "
+            f"about {formatDuration(estimate['seconds'])}")
+    if windowedReads:
+        text += " (less with windowed reads, which only fetch the AOI)"
+    if estimate["unsizedTiles"]:
+        text += f"; {estimate['unsizedTiles']} DEMs have no size in the index and aren't counted"
+    return text
+
+
+def remoteSources(demLinks, cache):
+    # GDAL paths for reading the DEMs in place: the cached copy if there is one, otherwise the remote tile
+    # through /vsicurl/, where only the internal blocks that are actually read get requested
+    gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+    gdal.SetConfigOption("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif")
+    gdal.SetConfigOption("GDAL_HTTP_MULTIRANGE", "YES")
+    with DownloadEngine(downloadWorkers, perHostLimit=downloadWorkers) as engine:
+        cachedPaths = [future.result() for future in [engine.submit(cache.cached, engine, httpPath) for httpPath in demLinks]]
+    return [cachedPath or "/vsicurl/" + httpPath for httpPath, cachedPath in zip(demLinks, cachedPaths)]
+
+
+def clipMosaic(demList, boundaryFC, savefile, where=None):
+    # Build a virtual mosaic (VRT) over the DEMs and warp it through the AOI as a cutline, so only the blocks
+    # under the AOI are ever read, and the output is written a chunk at a time
+    # where optionally limits the AOI to some of the features in boundaryFC
+    projection = demProjection(demList)
+    cutlineFile = f"/vsimem/{os.path.basename(savefile)}_cutline.shp"
+    writeCutline(boundaryFC, projection, cutlineFile, where)
+    outCells, tileCells = warpMosaic(demList, projection, cutlineFile, savefile)
+    arcpy.AddMessage(f"Output covers {outCells:,} cells, {100 * outCells / max(tileCells, 1):.1f}% of the {len(demList)} DEMs")
+
+
+def demProjection(demList):
+    # Projection of the first DEM, which the output is in
+    first = gdal.Open(demList[0])
+    if first is None:
+        arcpy.AddError(f"ERROR opening {demList[0]}")
+    projection = first.GetProjection()
+    first = None
+    if not all(osr.SpatialReference(gdal.Open(dem).GetProjection()).IsSame(osr.SpatialReference(projection)) for dem in demList[1:]):
+        arcpy.AddWarning("DEMs are in more than one projection; they will be reprojected to match the first")
+    return projection
+
+
+def writeCutline(boundaryFC, projection, cutlineFile, where=None):
+    # The AOI polygons, in the DEM's projection, as an in-memory shapefile for gdal.Warp
+    sr = arcpy.SpatialReference()
+    sr.loadFromString(projection)
+    cutlineSR = osr.SpatialReference(projection)
+    cutlineDS = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(cutlineFile)
+    cutlineLayer = cutlineDS.CreateLayer("aoi", cutlineSR, ogr.wkbMultiPolygon)
+    with arcpy.da.SearchCursor(boundaryFC, ["SHAPE@WKT"], where, spatial_reference=sr) as cursor:
+        for row in cursor:
+            if row[0]:
+                feature = ogr.Feature(cutlineLayer.GetLayerDefn())
+                feature.SetGeometry(ogr.CreateGeometryFromWkt(row[0]))
+                cutlineLayer.CreateFeature(feature)
+                feature = None
+    cutlineDS = None
+    return cutlineFile
+
+
+def warpMosaic(demList, projection, cutlineFile, savefile):
+    # GDAL only (no arcpy), so several of these can run at once on threads; removes cutlineFile when done
+    # Returns (cells in the output, cells in the DEMs) for reporting
+    # The VRT (like gdal.Warp) takes pixels from the last source listed, so reverse the list to get the same
+    # result as the "FIRST" merge; DEMs in a different projection can't go in a VRT, so warp those directly
+    vrtFile = f"/vsimem/{os.path.basename(savefile)}_mosaic.vrt"
+    sameProjection = all(osr.SpatialReference(gdal.Open(dem).GetProjection()).IsSame(osr.SpatialReference(projection)) for dem in demList[1:])
+    if sameProjection:
+        gdal.BuildVRT(vrtFile, list(reversed(demList)))
+        sources = [vrtFile]
+    else:
+        sources = list(reversed(demList))
+
+    gdal.Warp(savefile, sources, format="GTiff", dstSRS=projection, cutlineDSName=cutlineFile, cropToCutline=True,
+              multithread=True, warpMemoryLimit=256 * 1024 * 1024,
+              creationOptions=["COMPRESS=LZW", "TILED=YES", "BIGTIFF=IF_SAFER"])
+
+    # How much of the tiles was actually needed
+    out = gdal.Open(savefile)
+    outCells = out.RasterXSize * out.RasterYSize
+    out = None
+    tileCells = 0
+    for dem in demList:
+        ds = gdal.Open(dem)
+        tileCells += ds.RasterXSize * ds.RasterYSize
+        ds = None
+
+    if sameProjection:
+        gdal.Unlink(vrtFile)
+    ogr.GetDriverByName("ESRI Shapefile").DeleteDataSource(cutlineFile)
+    return outCells, tileCells
+
 
 
 
@@ -97,9 +321,10 @@ if __name__ == '__main__':
     contourInterval = arcpy.GetParameterAsText(4)
     srs = arcpy.GetParameterAsText(5)
     outShpFilename = arcpy.GetParameterAsText(6)
+    dryRun = arcpy.GetArgumentCount() > 7 and arcpy.GetParameterAsText(7) == 'true'
 
-    derivedDEM = fetchDEM(boundaryFC, outDir, outTiffFilename)
+    derivedDEM = fetchDEM(boundaryFC, outDir, outTiffFilename, dryRun)
 
     # Also build contours if this option is set
-    if optionBuildContours == 'true':
+    if optionBuildContours == 'true' and derivedDEM is not None:
         buildContours(derivedDEM, outDir, outShpFilename, contourInterval, srs)
@@ -0,0 +1,126 @@
+'''
+Geoprocessing Tool which fetches clipped DEMs for every AOI in a feature class in one run
+The tiles needed by all of the AOIs are worked out first, so a tile shared by several AOIs is downloaded once,
+then each AOI is mosaicked and clipped from the shared tiles, several AOIs at a time
+'''
+
+clipWorkers = 4         # AOIs mosaicked and clipped at the same time (gdal.Warp releases the GIL, so threads are enough)
+
+import arcpy
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from fetchDEM import defaultDEMindex, coverageFields, tileCacheDir, tileCacheBytes, tileSelection, fetchTiles, demProjection, writeCutline, warpMosaic
+from buildContours import buildContours
+from tileCache import TileCache
+from demIndex import DEMIndex, geometryRings
+from tileSelection import selectTiles
+
+
+def fetchDEMBatch(aoiFC, nameField, outDir, optionBuildContours=False, contourInterval=None, srs=None):
+    # Check 1m DEM Index
+    if arcpy.Exists(defaultDEMindex):
+        count = arcpy.management.GetCount(defaultDEMindex)
+        arcpy.AddMessage(f"Found {count} DEMs indexed in {defaultDEMindex}")
+    else:
+        arcpy.AddError(f"ERROR! Could not find DEM index in {defaultDEMindex}")
+
+    # Which DEMs each AOI needs
+    arcpy.SetProgressor("default", f"Checking for DEMs which intersect each AOI...")
+    aois = aoiTiles(aoiFC, nameField)
+    needed = list(dict.fromkeys(link for _, _, links in aois for link in links))
+    references = sum(len(links) for _, _, links in aois)
+    arcpy.AddMessage(f"{len(aois)} AOIs need {references} DEMs between them, {len(needed)} of them different")
+    if not needed:
+        arcpy.AddError("No DEMs in the index file intersect your AOIs! Check the index to see the coverage area")
+        return []
+
+    # Each DEM comes over the network (or out of the tile cache) once, however many AOIs use it
+    cache = TileCache(tileCacheDir, tileCacheBytes)
+    tiles = fetchTiles(needed, cache)
+
+    # Cutlines are written here (arcpy isn't safe on threads), then the warps run on the pool
+    arcpy.AddMessage(f"\nMosaicking and clipping {len(aois)} AOIs...")
+    oidField = arcpy.AddFieldDelimiters(aoiFC, arcpy.Describe(aoiFC).OIDFieldName)
+    jobs = []
+    with ThreadPoolExecutor(clipWorkers) as executor:
+        for oid, name, links in aois:
+            demList = [tiles[link] for link in links if link in tiles]
+            if not demList:
+                arcpy.AddWarning(f"No DEMs available for AOI {name}; skipping it")
+                continue
+            savefile = os.path.join(outDir, f"{name}.tif")
+            projection = demProjection(demList)
+            cutlineFile = writeCutline(aoiFC, projection, f"/vsimem/{name}_cutline.shp", f"{oidField} = {oid}")
+            jobs.append((name, savefile, executor.submit(warpMosaic, demList, projection, cutlineFile, savefile)))
+
+        arcpy.SetProgressor("step", f"Clipping {len(jobs)} AOIs...", 0, len(jobs), 1)
+        outputs = []
+        for name, savefile, future in jobs:
+            if future.exception() is not None:
+                arcpy.AddError(f"ERROR clipping AOI {name}: {future.exception()}")
+            else:
+                outCells, tileCells = future.result()
+                arcpy.AddMessage(f"{name}: {outCells:,} cells, {100 * outCells / max(tileCells, 1):.1f}% of its DEMs")
+                outputs.append((name, savefile))
+            arcpy.SetProgressorPosition()
+    arcpy.AddMessage(cache.summary())
+    arcpy.ResetProgressor()
+
+    # Add DEMs to map
+    aprx = arcpy.mp.ArcGISProject("CURRENT")
+    for name, savefile in outputs:
+        aprx.activeMap.addDataFromPath(savefile)
+
+    # Contours run one AOI at a time; they are arcpy geoprocessing
+    if optionBuildContours:
+        for name, savefile in outputs:
+            arcpy.AddMessage(f"\nBuilding contours for AOI {name}")
+            buildContours(savefile, outDir, f"{name}_contours.shp", contourInterval, srs)
+
+    arcpy.AddMessage("Success!")
+
+    return [savefile for name, savefile in outputs]
+
+
+def aoiTiles(aoiFC, nameField=None):
+    # (objectId, output name, [DEM links in merge order]) for each AOI; only the DEMs needed to cover it (see tileSelection)
+    index = DEMIndex.load(defaultDEMindex, coverageFields)
+    sr = arcpy.SpatialReference()
+    sr.loadFromString(index.spatialReferenceWKT)
+    fields = ["OID@", "Shape@"] + ([nameField] if nameField else [])
+    aois = []
+    names = set()
+    with arcpy.da.SearchCursor(aoiFC, fields, spatial_reference=sr) as cursor:
+        for row in cursor:
+            if row[1] is None:
+                continue
+            name = outputName(row[2] if nameField and row[2] not in (None, "") else f"aoi_{row[0]}")
+            if name in names:
+                name = f"{name}_{row[0]}"
+            names.add(name)
+            rings = geometryRings(row[1])
+            selected = selectTiles(index.intersectingFootprints(rings), [rings], tileSelection, index.spatialReferenceWKT)
+            aois.append((row[0], name, [link for _, _, link in selected]))
+    return aois
+
+
+def outputName(value):
+    # Something safe to use as a file name
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(value)).strip("_") or "aoi"
+
+
+
+
+# This is used to execute code if the file was run but not imported
+if __name__ == '__main__':
+
+    # Tool parameter accessed with GetParameter or GetParameterAsText
+    aoiFC = arcpy.GetParameterAsText(0)
+    nameField = arcpy.GetParameterAsText(1)
+    outDir = arcpy.GetParameterAsText(2)
+    optionBuildContours = arcpy.GetParameterAsText(3)
+    contourInterval = arcpy.GetParameterAsText(4)
+    srs = arcpy.GetParameterAsText(5)
+
+    fetchDEMBatch(aoiFC, nameField, outDir, optionBuildContours == 'true', contourInterval, srs)
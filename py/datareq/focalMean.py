@@ -0,0 +1,113 @@
+'''
+Focal mean of a DEM (a square moving window, like FocalStatistics "Rectangle 5 5 CELL" MEAN with DATA),
+computed in tiles on a process pool
+Each worker reads its tile plus a halo of window // 2 cells from the source, and takes window sums from a
+summed-area table of the values and of the valid-cell counts, so nodata cells are left out of the mean and a
+cell gets a value if any cell in its window has data. Tiles come back to this process and are written
+straight into the output GeoTIFF
+A scale factor (ie. meters to feet) can be applied in the same pass, and smoothedBlock lets other tiled
+stages (the contour workers) smooth their own blocks as they read them, with no intermediate raster at all
+'''
+
+import os
+import sys
+import numpy as np
+from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from poolExecutable import setPoolExecutable
+
+defaultWindow = 5                                       # cells per side of the window
+defaultTileSize = 2048                                  # cells per side of the tiles handed to the workers
+defaultWorkers = max(1, (os.cpu_count() or 2) - 1)
+outputNoData = float(np.finfo(np.float32).min)          # same as ArcGIS uses for float rasters
+feetPerMeter = 1 / 0.3048                               # international foot, as UnitConversion uses
+
+
+def focalMean(inPath, outPath, window=defaultWindow, tileSize=defaultTileSize, workers=defaultWorkers, progress=None, scale=1.0):
+    # Writes the focal mean of band 1 of inPath, times scale, to outPath (float32 GeoTIFF); progress, if given,
+    # is called with the fraction of tiles done
+    src = gdal.Open(inPath)
+    if src is None:
+        raise IOError(f"GDAL could not open {inPath}")
+    width, height = src.RasterXSize, src.RasterYSize
+    driver = gdal.GetDriverByName("GTiff")
+    out = driver.Create(outPath, width, height, 1, gdal.GDT_Float32,
+                        ["COMPRESS=LZW", "PREDICTOR=3", "TILED=YES", "BIGTIFF=IF_SAFER"])
+    out.SetGeoTransform(src.GetGeoTransform())
+    out.SetProjection(src.GetProjection())
+    outBand = out.GetRasterBand(1)
+    outBand.SetNoDataValue(outputNoData)
+    src = None
+
+    tiles = [(x, y, min(tileSize, width - x), min(tileSize, height - y)) for y in range(0, height, tileSize) for x in range(0, width, tileSize)]
+    total = len(tiles)
+    done = 0
+    setPoolExecutable()
+    with ProcessPoolExecutor(workers) as pool:
+        # Keep a couple of tiles per worker in flight, so finished tiles don't pile up in memory
+        tiles = iter(tiles)
+        pending = {}
+        while True:
+            for tile in tiles:
+                pending[pool.submit(meanTile, inPath, tile, window, scale)] = tile
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                x, y, _, _ = pending.pop(future)
+                outBand.WriteArray(future.result(), x, y)
+                done += 1
+                if progress is not None:
+                    progress(done / total)
+
+    outBand.FlushCache()
+    out = None
+    return outPath
+
+
+def meanTile(inPath, tile, window, scale=1.0):
+    # Runs in the worker processes: read the tile with its halo and return its focal mean as float32
+    src = gdal.Open(inPath)
+    block = smoothedBlock(src.GetRasterBand(1), *tile, window, scale)
+    src = None
+    return block
+
+
+def smoothedBlock(band, x, y, tileWidth, tileHeight, window=defaultWindow, scale=1.0):
+    # Focal mean (times scale) of the block of band at x, y, reading just the halo it needs around it
+    # Cells with no data in their window come back as outputNoData
+    halo = window // 2
+    x0, y0 = max(x - halo, 0), max(y - halo, 0)
+    x1, y1 = min(x + tileWidth + halo, band.XSize), min(y + tileHeight + halo, band.YSize)
+    values = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.float64)
+    nodata = band.GetNoDataValue()
+
+    valid = ~np.isnan(values)
+    if nodata is not None:
+        valid &= values != nodata
+
+    # Off the edge of the raster counts as nodata
+    padding = ((halo - (y - y0), halo - (y1 - y - tileHeight)), (halo - (x - x0), halo - (x1 - x - tileWidth)))
+    values = np.pad(np.where(valid, values, 0.0), padding)
+    valid = np.pad(valid, padding)
+    return windowMean(values, valid, window, scale)
+
+
+def windowMean(values, valid, window, scale=1.0):
+    # Mean of the valid cells in each window x window block of the padded arrays, times scale; the result is
+    # window - 1 smaller in each direction. Cells with no valid cells in their window get outputNoData
+    sums = boxSum(values, window)
+    counts = boxSum(valid.astype(np.float64), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums * scale / counts
+    return np.where(counts > 0.5, mean, outputNoData).astype(np.float32)
+
+
+def boxSum(a, window):
+    # Window sums from a summed-area table
+    table = np.zeros((a.shape[0] + 1, a.shape[1] + 1))
+    np.cumsum(np.cumsum(a, axis=0), axis=1, out=table[1:, 1:])
+    return table[window:, window:] - table[:-window, window:] - table[window:, :-window] + table[:-window, :-window]
@@ -0,0 +1,163 @@
+'''
+Valid-data footprints of rasters, built in memory with NumPy
+The raster's mask is read in strips of rows and reduced to a coarse grid (a coarse cell is valid if any pixel
+in it has data), so memory stays bounded even on 10k x 10k DEMs. The outer boundary of the valid cells is then
+traced along the cell edges and simplified with Douglas-Peucker, giving polygon rings in map coordinates
+'''
+
+import math
+import numpy as np
+from osgeo import gdal
+
+defaultMaxMaskSize = 2048     # longest side of the coarse mask, in cells
+defaultTolerance = 1.0        # simplification tolerance, in coarse cells
+stripBytes = 64 * 1024 * 1024 # roughly how much mask is read from the raster at once
+
+
+def rasterFootprint(path, maxMaskSize=defaultMaxMaskSize, tolerance=defaultTolerance):
+    # Returns (rings, projection WKT) for a raster on disk; rings are lists of (x, y) in the raster's coordinates
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IOError(f"GDAL could not open {path}")
+    factor = max(1, math.ceil(max(ds.RasterXSize, ds.RasterYSize) / maxMaskSize))
+    valid = readValidMask(ds.GetRasterBand(1), factor)
+    rings = maskFootprint(valid, ds.GetGeoTransform(), factor, ds.RasterXSize, ds.RasterYSize, tolerance)
+    projection = ds.GetProjection()
+    ds = None
+    return rings, projection
+
+
+def readValidMask(band, factor):
+    # Coarse boolean mask of the band, factor x factor pixels per cell, read a strip of rows at a time
+    width, height = band.XSize, band.YSize
+    maskBand = band.GetMaskBand()   # honours nodata values and internal masks alike
+    coarseWidth = math.ceil(width / factor)
+    stripRows = max(factor, (stripBytes // max(width, 1)) // factor * factor)
+    strips = []
+    for y in range(0, height, stripRows):
+        rows = min(stripRows, height - y)
+        strip = maskBand.ReadAsArray(0, y, width, rows) > 0
+        strips.append(reduceMask(strip, factor, coarseWidth))
+    return np.vstack(strips)
+
+
+def reduceMask(strip, factor, coarseWidth):
+    # Pad the strip out to whole cells, then a cell is valid if any of its pixels are
+    rows, cols = strip.shape
+    padded = np.zeros((math.ceil(rows / factor) * factor, coarseWidth * factor), dtype=bool)
+    padded[:rows, :cols] = strip
+    return padded.reshape(padded.shape[0] // factor, factor, coarseWidth, factor).any(axis=(1, 3))
+
+
+def maskFootprint(valid, geotransform, factor=1, width=None, height=None, tolerance=defaultTolerance):
+    # Outer rings (no holes) of the valid cells, simplified and converted to map coordinates
+    # width/height are the full-resolution raster size, so the last partial cells stop at the raster edge
+    width = valid.shape[1] * factor if width is None else width
+    height = valid.shape[0] * factor if height is None else height
+    rings = []
+    for ring in traceOuterRings(valid):
+        ring = simplifyRing(ring, tolerance)
+        pixels = np.minimum(ring * factor, [width, height])
+        xs = geotransform[0] + pixels[:, 0] * geotransform[1] + pixels[:, 1] * geotransform[2]
+        ys = geotransform[3] + pixels[:, 0] * geotransform[4] + pixels[:, 1] * geotransform[5]
+        rings.append(list(zip(xs.tolist(), ys.tolist())))
+    return rings
+
+
+def traceOuterRings(valid):
+    # Boundary edges between valid and invalid cells are found with array shifts, oriented so that the
+    # valid side is always on the same side; chaining them gives closed rings, and with rows going down
+    # outer rings come out with positive area and holes with negative area
+    padded = np.pad(valid, 1)
+    core = padded[1:-1, 1:-1]
+    r, c = np.nonzero(core & ~padded[:-2, 1:-1])        # top edges, left to right
+    edges = [np.column_stack([c, r, c + 1, r])]
+    r, c = np.nonzero(core & ~padded[1:-1, 2:])         # right edges, downwards
+    edges.append(np.column_stack([c + 1, r, c + 1, r + 1]))
+    r, c = np.nonzero(core & ~padded[2:, 1:-1])         # bottom edges, right to left
+    edges.append(np.column_stack([c + 1, r + 1, c, r + 1]))
+    r, c = np.nonzero(core & ~padded[1:-1, :-2])        # left edges, upwards
+    edges.append(np.column_stack([c, r + 1, c, r]))
+    edges = np.vstack(edges)
+
+    # Chain the edges into rings
+    outgoing = {}
+    for x0, y0, x1, y1 in edges.tolist():
+        outgoing.setdefault((x0, y0), []).append((x1, y1))
+    rings = []
+    while outgoing:
+        start = next(iter(outgoing))
+        ring = [start]
+        vertex = start
+        while True:
+            nextVertices = outgoing[vertex]
+            nextVertex = nextVertices.pop()
+            if not nextVertices:
+                del outgoing[vertex]
+            vertex = nextVertex
+            if vertex == start:
+                break
+            ring.append(vertex)
+        ring = np.array(ring + [start], dtype=float)
+        if ringArea(ring) > 0:
+            rings.append(ring)
+
+    # Drop outer rings of islands sitting inside the holes of a bigger part (the holes themselves are dropped)
+    rings.sort(key=ringArea, reverse=True)
+    outer = []
+    for ring in rings:
+        if not any(pointInRing(ring[0] + 0.5, bigger) for bigger in outer):
+            outer.append(ring)
+    return outer
+
+
+def ringArea(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def pointInRing(point, ring):
+    # Even-odd rule, vectorised over the ring's edges
+    x, y = point
+    x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xCross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crosses & (x < xCross)) % 2)
+
+
+def simplifyRing(ring, tolerance):
+    # Douglas-Peucker on a closed ring: split it at the vertex furthest from the start, simplify both halves
+    if len(ring) <= 4 or tolerance <= 0:
+        return ring
+    far = int(np.argmax(np.hypot(*(ring - ring[0]).T)))
+    first = simplifyLine(ring[:far + 1], tolerance)
+    second = simplifyLine(ring[far:], tolerance)
+    simplified = np.vstack([first, second[1:]])
+    return simplified if len(simplified) >= 4 else ring
+
+
+def simplifyLine(line, tolerance):
+    # Iterative Douglas-Peucker; each pass measures every point of a span against its chord at once
+    keep = np.zeros(len(line), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(line) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = line[first], line[last]
+        points = line[first + 1:last]
+        chord = end - start
+        chordLength = math.hypot(*chord)
+        if chordLength == 0:
+            distances = np.hypot(*(points - start).T)
+        else:
+            distances = np.abs(chord[0] * (points[:, 1] - start[1]) - chord[1] * (points[:, 0] - start[0])) / chordLength
+        worst = int(np.argmax(distances))
+        if distances[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return line[keep]
@@ -9,9 +9,12 @@ coverageFields = ["Parcel_Status", "Data_Path"]       # the fields we need from
 
 import arcpy
 import os
+import time
+from runHistory import RunHistory, formatDuration
 
 
-def clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI):
+def clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI, dryRun=False):
+    # With dryRun, only reports how many parcels would be output and how long it should take
     # Check Parcel Index
     arcpy.AddMessage("Checking data sources...")
     if arcpy.Exists(defaultParcelIndex):
@@ -43,6 +46,21 @@ def clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI):
         arcpy.AddMessage(f"Found {regionCount} match that intersects the AOI...")
 
 
+    # Size up the job before starting it
+    history = RunHistory()
+    if dryRun:
+        arcpy.SetProgressor("default", f"Counting intersecting parcels...")
+        total = 0
+        with arcpy.da.SearchCursor(intersectingRegions, coverageFields) as cursor:
+            for row in cursor:
+                dataSource = os.path.join(parcelDB, row[1])
+                count = int(arcpy.management.GetCount(arcpy.management.SelectLayerByLocation(dataSource, 'INTERSECT', boundaryFC))[0])
+                arcpy.AddMessage(f"{count:,} parcels intersect the AOI in {dataSource}")
+                total += count
+        arcpy.AddMessage(f"Estimate: {total:,} parcels from {regionCount} sources, about {formatDuration(history.estimate('parcels', total))}")
+        arcpy.AddMessage("Dry run; nothing was output")
+        return
+
     # Get the data source from index file
     fcList = []
     arcpy.AddMessage(f"\nLoading intersecting parcel feature classes...")
@@ -61,6 +79,7 @@ def clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI):
  
 
             # Clip parcels using output SRS
+            start = time.time()
             arcpy.env.outputCoordinateSystem = srs
             # savefile = os.path.join(outDir, outFilename)
             if clipToAOI == 'false':
@@ -72,6 +91,7 @@ def clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI):
                 # Clip parcels to AOI
                 arcpy.SetProgressor("default", f"Clipping and outputting parcels which intersect the AOI")
                 arcpy.analysis.Clip(dataSource, boundaryFC, savefile, None)
+            history.record("parcels", int(arcpy.management.GetCount(savefile)[0]), time.time() - start)
 
             # Add Parcels to Map
             aprx = arcpy.mp.ArcGISProject("CURRENT")
@@ -91,5 +111,6 @@ if __name__ == '__main__':
     outFilename = arcpy.GetParameterAsText(2)
     srs = arcpy.GetParameterAsText(3)
     clipToAOI = arcpy.GetParameterAsText(4)
+    dryRun = arcpy.GetArgumentCount() > 5 and arcpy.GetParameterAsText(5) == 'true'
     
-    clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI)
+    clipParcels(boundaryFC, outDir, outFilename, srs, clipToAOI, dryRun)
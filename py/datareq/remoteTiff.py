@@ -0,0 +1,200 @@
+'''
+Reads the georeferencing of a remote GeoTIFF without downloading it
+The TIFF header and tags are fetched with HTTP Range requests (a few KB instead of hundreds of MB),
+which is enough to get the size, geotransform, EPSG code and nodata value of a USGS DEM tile
+'''
+
+import struct
+from osgeo import gdal
+from footprint import maskFootprint
+
+headerReadSize = 65536      # first request; the USGS (COG style) tiles keep all their tags at the front of the file
+
+# TIFF tags we care about
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_MODEL_PIXEL_SCALE = 33550
+TAG_MODEL_TIEPOINT = 33922
+TAG_MODEL_TRANSFORMATION = 34264
+TAG_GEO_KEY_DIRECTORY = 34735
+TAG_GDAL_NODATA = 42113
+
+# GeoKeys
+KEY_RASTER_TYPE = 1025
+KEY_GEOGRAPHIC_TYPE = 2048
+KEY_PROJECTED_CS_TYPE = 3072
+KEY_USER_DEFINED = 32767
+
+# TIFF field type -> (size in bytes, struct code)
+fieldTypes = {
+    1: (1, 'B'), 2: (1, 's'), 3: (2, 'H'), 4: (4, 'I'), 5: (8, 'II'), 6: (1, 'b'), 7: (1, 'B'),
+    8: (2, 'h'), 9: (4, 'i'), 10: (8, 'ii'), 11: (4, 'f'), 12: (8, 'd'), 16: (8, 'Q'), 17: (8, 'q'), 18: (8, 'Q'),
+}
+
+
+class RangeReader:
+    # Serves byte ranges of a remote file, caching what has already been fetched
+    def __init__(self, engine, url):
+        self.engine = engine
+        self.url = url
+        self.blocks = []    # list of (start, bytes)
+        self.requests = 0
+        self.bytesRead = 0
+
+    def read(self, offset, length):
+        for start, data in self.blocks:
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset - start + length]
+        data = self.engine.getRange(self.url, offset, max(length, 16384))
+        self.requests += 1
+        self.bytesRead += len(data)
+        if len(data) < length:
+            raise IOError(f"Short read from {self.url} at byte {offset}")
+        self.blocks.append((offset, data))
+        return data[:length]
+
+
+def _readIFD(reader, offset, endian, bigTiff):
+    # Returns {tag: tuple of values} for the IFD at offset, and the offset of the next IFD
+    countFormat, entryFormat, entrySize, inlineSize = ('Q', 'HHQ', 20, 8) if bigTiff else ('H', 'HHI', 12, 4)
+    countSize = struct.calcsize(endian + countFormat)
+    count = struct.unpack(endian + countFormat, reader.read(offset, countSize))[0]
+    raw = reader.read(offset + countSize, count * entrySize + inlineSize)
+
+    tags = {}
+    for i in range(count):
+        entry = raw[i * entrySize:(i + 1) * entrySize]
+        tag, fieldType, valueCount = struct.unpack(endian + entryFormat, entry[:struct.calcsize(endian + entryFormat)])
+        if fieldType not in fieldTypes:
+            continue
+        size, code = fieldTypes[fieldType]
+        dataLength = size * valueCount
+        if dataLength <= inlineSize:
+            data = entry[entrySize - inlineSize:entrySize - inlineSize + dataLength]
+        else:
+            dataOffset = struct.unpack(endian + ('Q' if bigTiff else 'I'), entry[entrySize - inlineSize:])[0]
+            data = reader.read(dataOffset, dataLength)
+        if code == 's':
+            tags[tag] = (data.rstrip(b'\x00').decode('ascii', 'replace'),)
+        else:
+            tags[tag] = struct.unpack(endian + code * valueCount, data)
+
+    nextOffset = struct.unpack(endian + ('Q' if bigTiff else 'I'), raw[count * entrySize:count * entrySize + inlineSize])[0]
+    return tags, nextOffset
+
+
+def readTiffHeader(engine, url):
+    # Returns a dict with width, height, geotransform (GDAL order), epsg, nodata and overviews (count)
+    reader = RangeReader(engine, url)
+    reader.blocks.append((0, engine.getRange(url, 0, headerReadSize)))
+    reader.requests += 1
+    reader.bytesRead += len(reader.blocks[0][1])
+
+    head = reader.read(0, 8)
+    if head[:2] == b'II':
+        endian = '<'
+    elif head[:2] == b'MM':
+        endian = '>'
+    else:
+        raise ValueError(f"{url} is not a TIFF")
+    version = struct.unpack(endian + 'H', head[2:4])[0]
+    if version == 42:
+        bigTiff = False
+        ifdOffset = struct.unpack(endian + 'I', head[4:8])[0]
+    elif version == 43:
+        bigTiff = True
+        ifdOffset = struct.unpack(endian + 'Q', reader.read(8, 8))[0]
+    else:
+        raise ValueError(f"{url} is not a TIFF")
+
+    tags, nextOffset = _readIFD(reader, ifdOffset, endian, bigTiff)
+
+    # Count the reduced-resolution IFDs that follow (overviews), without reading their tag data
+    overviews = 0
+    while nextOffset:
+        ovTags, nextOffset = _readIFD(reader, nextOffset, endian, bigTiff)
+        if ovTags.get(TAG_NEW_SUBFILE_TYPE, (0,))[0] == 1:
+            overviews += 1
+
+    width = tags[TAG_IMAGE_WIDTH][0]
+    height = tags[TAG_IMAGE_LENGTH][0]
+    geoKeys = _parseGeoKeys(tags.get(TAG_GEO_KEY_DIRECTORY, ()))
+
+    # Geotransform from either the affine transformation tag or the tiepoint + pixel scale pair
+    if TAG_MODEL_TRANSFORMATION in tags:
+        m = tags[TAG_MODEL_TRANSFORMATION]
+        geotransform = [m[3], m[0], m[1], m[7], m[4], m[5]]
+    elif TAG_MODEL_TIEPOINT in tags and TAG_MODEL_PIXEL_SCALE in tags:
+        i, j, _, x, y, _ = tags[TAG_MODEL_TIEPOINT][:6]
+        sx, sy = tags[TAG_MODEL_PIXEL_SCALE][:2]
+        geotransform = [x - i * sx, sx, 0.0, y + j * sy, 0.0, -sy]
+    else:
+        raise ValueError(f"{url} has no georeferencing tags")
+    if geoKeys.get(KEY_RASTER_TYPE) == 2:
+        # PixelIsPoint; shift to the corner of the pixel like GDAL does
+        geotransform[0] -= 0.5 * geotransform[1]
+        geotransform[3] -= 0.5 * geotransform[5]
+
+    epsg = geoKeys.get(KEY_PROJECTED_CS_TYPE) or geoKeys.get(KEY_GEOGRAPHIC_TYPE)
+    if epsg in (None, KEY_USER_DEFINED):
+        epsg = None
+
+    nodata = None
+    if TAG_GDAL_NODATA in tags:
+        try:
+            nodata = float(tags[TAG_GDAL_NODATA][0])
+        except ValueError:
+            pass
+
+    return {
+        "width": width,
+        "height": height,
+        "geotransform": tuple(geotransform),
+        "epsg": epsg,
+        "nodata": nodata,
+        "overviews": overviews,
+        "bytesRead": reader.bytesRead,
+        "requests": reader.requests,
+    }
+
+
+def _parseGeoKeys(directory):
+    # Only the keys stored directly in the directory (short values) are needed here
+    keys = {}
+    if len(directory) < 4:
+        return keys
+    for k in range(directory[3]):
+        keyId, location, count, value = directory[4 + k * 4:8 + k * 4]
+        if location == 0:
+            keys[keyId] = value
+    return keys
+
+
+def headerBounds(header):
+    # (xmin, ymin, xmax, ymax) of the full raster
+    gt = header["geotransform"]
+    xs = [gt[0] + col * gt[1] + row * gt[2] for col, row in ((0, 0), (header["width"], 0), (0, header["height"]), (header["width"], header["height"]))]
+    ys = [gt[3] + col * gt[4] + row * gt[5] for col, row in ((0, 0), (header["width"], 0), (0, header["height"]), (header["width"], header["height"]))]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def overviewFootprint(url, tolerance=1.0):
+    # Coarse valid-data footprint from the smallest overview, read through GDAL's /vsicurl/ (range reads)
+    # Returns polygon rings in the raster's coordinates (empty if the tile holds no data at all)
+    gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")   # don't list the whole USGS directory
+    gdal.SetConfigOption("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif")
+    ds = gdal.Open("/vsicurl/" + url)
+    if ds is None:
+        raise IOError(f"GDAL could not open {url}")
+    band = ds.GetRasterBand(1)
+    reduced = band.GetOverview(band.GetOverviewCount() - 1) if band.GetOverviewCount() > 0 else band
+    if reduced.XSize * reduced.YSize > 4096 * 4096:
+        raise ValueError(f"{url} has no overviews small enough to read")
+
+    # Use the mask band, so internal masks and nodata are both honoured
+    valid = reduced.GetMaskBand().ReadAsArray() > 0
+    factor = ds.RasterXSize / reduced.XSize
+    rings = maskFootprint(valid, ds.GetGeoTransform(), factor, ds.RasterXSize, ds.RasterYSize, tolerance)
+    ds = None
+    return rings
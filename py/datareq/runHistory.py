@@ -0,0 +1,69 @@
+'''
+Throughput measured on previous runs of the tools, kept per user in a small SQLite database
+Used to turn the size of a job into an estimated run time before it starts
+'''
+
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+defaultHistoryFile = os.path.join(os.environ.get("LOCALAPPDATA", tempfile.gettempdir()), "TWMTools", "runHistory.sqlite")
+recentRuns = 10         # rates are averaged over this many of the latest runs of each stage
+
+# Rates assumed until a stage has been timed on this machine
+defaultRates = {
+    "download": 20 * 1024 ** 2,     # bytes per second
+    "mosaic": 50 * 1000 ** 2,       # DEM cells read per second while mosaicking and clipping
+    "parcels": 2000,                # parcel features written per second
+}
+
+
+class RunHistory:
+    def __init__(self, path=None):
+        self.path = path or defaultHistoryFile
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    stage TEXT,
+                    amount REAL,
+                    seconds REAL,
+                    finished REAL
+                )""")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, stage, amount, seconds):
+        # amount is in the stage's unit (see defaultRates); tiny runs say more about overhead than throughput
+        if amount <= 0 or seconds < 1:
+            return
+        with self._connect() as db:
+            db.execute("INSERT INTO runs VALUES (?, ?, ?, ?)", (stage, amount, seconds, time.time()))
+
+    def rate(self, stage):
+        # Amount per second over the recent runs of stage, or the default if it hasn't been timed yet
+        with self._connect() as db:
+            row = db.execute("SELECT SUM(amount), SUM(seconds) FROM (SELECT amount, seconds FROM runs WHERE stage = ? ORDER BY finished DESC LIMIT ?)", (stage, recentRuns)).fetchone()
+        if row[0] and row[1]:
+            return row[0] / row[1]
+        return defaultRates[stage]
+
+    def estimate(self, stage, amount):
+        # Seconds the stage should take for amount
+        return amount / self.rate(stage) if amount > 0 else 0.0
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m {seconds % 60:02d}s"
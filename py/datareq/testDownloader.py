@@ -0,0 +1,191 @@
+'''
+Offline check of the download engine and the remote TIFF header reader, with no arcpy and no network
+Serves synthetic GeoTIFFs from a local http.server that answers Range and If-Range requests like S3, can
+ignore Range altogether, and can cut connections off part way through a file, then runs
+DownloadEngine.download, getRange and readTiffHeader against it
+Run with the ArcGIS Pro Python (or any with urllib3, NumPy and GDAL): python testDownloader.py
+'''
+
+fileBytes = 4 * 1024 * 1024     # size of each synthetic GeoTIFF
+dropAfter = 1536 * 1024         # bytes of the body sent before a dropped connection is cut (more than
+                                # downloader.chunkSize, or nothing reaches the .part file to resume from)
+drops = 2                       # how many times each /drop/ file is cut off before it is sent whole
+
+import os
+import sys
+import struct
+import random
+import hashlib
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import downloader
+from downloader import DownloadEngine
+from remoteTiff import readTiffHeader
+
+# Retries don't need to wait on a local server
+downloader.backoffBase = 0.01
+
+
+def syntheticTiff(width, height, origin, cellSize, epsg, nodata, size, seed=0):
+    # Little-endian classic TIFF of size bytes: a main IFD with georeferencing (tiepoint and pixel scale, a
+    # projected CS GeoKey, GDAL nodata) followed by one overview IFD, then random bytes standing in for pixels
+    def ifd(entries, offset):
+        # entries: [(tag, type, values)]; values that don't fit in the entry go after the IFD
+        codes = {2: 's', 3: 'H', 4: 'I', 12: 'd'}
+        head = struct.pack('<H', len(entries))
+        dataOffset = offset + 2 + 12 * len(entries) + 4
+        body, extra = b'', b''
+        for tag, fieldType, values in sorted(entries):
+            data = values if fieldType == 2 else struct.pack('<' + codes[fieldType] * len(values), *values)
+            count = len(values)
+            if len(data) <= 4:
+                body += struct.pack('<HHI', tag, fieldType, count) + data.ljust(4, b'\x00')
+            else:
+                body += struct.pack('<HHII', tag, fieldType, count, dataOffset + len(extra))
+                extra += data + b'\x00' * (len(data) % 2)
+        return head + body, extra
+
+    geoKeys = (1, 1, 0, 2, 1025, 0, 1, 1, 3072, 0, 1, epsg)
+    main = [(256, 4, (width,)), (257, 4, (height,)), (258, 3, (32,)),
+            (33550, 12, (cellSize, cellSize, 0.0)), (33922, 12, (0.0, 0.0, 0.0, origin[0], origin[1], 0.0)),
+            (34735, 3, geoKeys), (42113, 2, f"{nodata:g}".encode("ascii") + b'\x00')]
+    overview = [(254, 4, (1,)), (256, 4, (width // 4,)), (257, 4, (height // 4,))]
+
+    mainIFD, mainExtra = ifd(main, 8)
+    overviewOffset = 8 + len(mainIFD) + 4 + len(mainExtra)
+    overviewOffset += overviewOffset % 2
+    overviewIFD, overviewExtra = ifd(overview, overviewOffset)
+    data = b'II' + struct.pack('<HI', 42, 8) + mainIFD + struct.pack('<I', overviewOffset) + mainExtra
+    data = data.ljust(overviewOffset, b'\x00') + overviewIFD + struct.pack('<I', 0) + overviewExtra
+    return data + random.Random(seed).randbytes(size - len(data))
+
+
+class TiffServer(ThreadingHTTPServer):
+    # files: {path: bytes}; paths under /norange/ ignore Range, paths under /drop/ are cut off the first drops times
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), TiffHandler)
+        self.files = files
+        self.log = []               # (method, path, Range header) of every request
+        self.dropped = {}
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class TiffHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        server = self.server
+        rangeHeader = self.headers.get("Range")
+        with server.lock:
+            server.log.append((self.command, self.path, rangeHeader))
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        start, end = 0, len(data) - 1
+        partial = False
+        if rangeHeader and not self.path.startswith("/norange/") and self.headers.get("If-Range", etag) == etag:
+            first, last = rangeHeader.split("=", 1)[1].split("-")
+            start = int(first)
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            partial = True
+
+        self.send_response(206 if partial else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        if not body:
+            return
+
+        chunk = data[start:end + 1]
+        with server.lock:
+            drop = self.path.startswith("/drop/") and server.dropped.get(self.path, 0) < drops and len(chunk) > dropAfter
+            if drop:
+                server.dropped[self.path] = server.dropped.get(self.path, 0) + 1
+        if drop:
+            # Send part of the body and hang up, like a connection reset part way through a tile
+            self.wfile.write(chunk[:dropAfter])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(chunk)
+
+
+def runChecks():
+    header = dict(width=10000, height=10000, origin=(500000.0, 4300000.0), cellSize=1.0, epsg=26915, nodata=-999999)
+    tiff = syntheticTiff(size=fileBytes, **header)
+    files = {"/plain/tile.tif": tiff, "/norange/tile.tif": tiff, "/drop/tile.tif": tiff}
+    server = TiffServer(files)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    failures = []
+
+    def check(name, ok, detail=""):
+        print(f"{'PASS' if ok else 'FAIL'}  {name}" + (f"  ({detail})" if not ok and detail != "" else ""))
+        if not ok:
+            failures.append(name)
+
+    with DownloadEngine(workers=4, perHostLimit=4) as engine, tempfile.TemporaryDirectory() as tempDir:
+        # Range reads, with a server that honours Range and one that sends the whole file instead
+        for path in ("/plain/tile.tif", "/norange/tile.tif"):
+            offset = fileBytes // 2
+            check(f"getRange {path}", engine.getRange(server.url(path), offset, 1000) == tiff[offset:offset + 1000])
+
+        # Header of the synthetic GeoTIFF, from range requests only
+        result = readTiffHeader(engine, server.url("/plain/tile.tif"))
+        expected = {"width": 10000, "height": 10000, "geotransform": (500000.0, 1.0, 0.0, 4300000.0, 0.0, -1.0),
+                    "epsg": 26915, "nodata": -999999.0, "overviews": 1}
+        check("readTiffHeader", all(result[key] == value for key, value in expected.items()),
+              {key: result[key] for key in expected})
+        check("readTiffHeader reads little", result["bytesRead"] < fileBytes // 10, f"{result['bytesRead']} bytes")
+
+        # Whole downloads: a clean one, and one whose connection is cut drops times and has to be resumed
+        for path in ("/plain/tile.tif", "/drop/tile.tif"):
+            savePath = os.path.join(tempDir, path.strip("/").replace("/", "_"))
+            progress = []
+            engine.download(server.url(path), savePath, progress.append)
+            with open(savePath, "rb") as f:
+                check(f"download {path}", f.read() == tiff)
+            check(f"download {path} progress", sum(progress) == fileBytes, f"{sum(progress)} bytes counted")
+            check(f"download {path} leaves no part files", not os.path.exists(savePath + ".part") and not os.path.exists(savePath + ".part.json"))
+
+        # Each attempt after a drop carries on from where the .part file got to
+        resumes = [int(rangeHeader[6:-1]) for method, path, rangeHeader in server.log if path == "/drop/tile.tif" and method == "GET" and rangeHeader]
+        check("dropped download resumed with Range", len(resumes) == drops and 0 < resumes[0] and resumes == sorted(set(resumes)), resumes)
+
+    server.shutdown()
+    server.server_close()
+    print(f"{len(failures)} failed" if failures else "All passed")
+    return not failures
+
+
+# This is used to execute code if the file was run but not imported
+if __name__ == '__main__':
+    sys.exit(0 if runChecks() else 1)
@@ -0,0 +1,52 @@
+'''
+Offline check of selectTiles on made-up footprints (in meters), with no arcpy and no index
+Run with the ArcGIS Pro Python (or any with GDAL): python testTileSelection.py
+'''
+
+import sys
+from tileSelection import selectTiles
+
+
+def box(minX, minY, maxX, maxY):
+    return [[(minX, minY), (maxX, minY), (maxX, maxY), (minX, maxY), (minX, minY)]]
+
+
+def runChecks():
+    failures = []
+
+    def check(name, got, expected):
+        ok = got == expected
+        print(f"{'PASS' if ok else 'FAIL'}  {name}" + ("" if ok else f"  (got {got}, expected {expected})"))
+        if not ok:
+            failures.append(name)
+
+    # Two adjacent tiles of the newest project, and an older one overlapping both
+    candidates = [
+        (1, "MO_New_2020", "A", box(0, 0, 1000, 1000)),
+        (2, "MO_New_2020", "B", box(1000, 0, 2000, 1000)),
+        (3, "MO_Old_2012", "C", box(500, 0, 1500, 1500)),
+    ]
+    links = lambda selected: [link for _, _, link in selected]
+
+    # An AOI across the seam of the newest tiles doesn't need the older tile
+    check("seam between newest tiles stays covered", links(selectTiles(candidates, [box(900, 400, 1100, 600)])), ["A", "B"])
+
+    # An AOI reaching past the newest tiles still gets the older tile for the rest
+    check("older tile fills past the newest", links(selectTiles(candidates, [box(900, 400, 1100, 1200)])), ["A", "B", "C"])
+
+    # An AOI inside one tile needs just that tile
+    check("AOI inside one tile", links(selectTiles(candidates, [box(100, 100, 400, 400)])), ["A"])
+
+    # An AOI inside a newest tile but within the slack of its outer edge also takes the older tile there
+    check("outer edge within the slack", links(selectTiles(candidates, [box(1400, 985, 1450, 995)])), ["B", "C"])
+
+    # "all" keeps every candidate, in index order
+    check("all", links(selectTiles(candidates, [box(900, 400, 1100, 600)], "all")), ["A", "B", "C"])
+
+    print(f"{len(failures)} failed" if failures else "All passed")
+    return not failures
+
+
+# This is used to execute code if the file was run but not imported
+if __name__ == '__main__':
+    sys.exit(0 if runChecks() else 1)
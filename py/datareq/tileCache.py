@@ -0,0 +1,159 @@
+'''
+Shared on-disk cache of downloaded DEM tiles
+Tiles are keyed by their URL plus the server's ETag (or size, if there is no ETag), so a tile that changes
+on the server is fetched again. The cache is kept under a byte budget by evicting the least recently used
+tiles, and several tool runs can use it at once: downloads go to a temp file that is renamed into place
+when complete, and the bookkeeping is in a SQLite database
+'''
+
+import os
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+defaultCacheDir = os.path.join(os.environ.get("LOCALAPPDATA", tempfile.gettempdir()), "TWMTools", "demCache")
+defaultCacheBytes = 50 * 1024 ** 3      # 50 GB
+inUseSeconds = 6 * 60 * 60              # tiles used this recently may still be open in another run; never evict them
+
+
+class TileCache:
+    def __init__(self, cacheDir=None, maxBytes=defaultCacheBytes):
+        self.cacheDir = cacheDir or defaultCacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(self.cacheDir, exist_ok=True)
+        self.dbPath = os.path.join(self.cacheDir, "cache.sqlite")
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    filename TEXT,
+                    bytes INTEGER,
+                    lastUsed REAL
+                )""")
+        # Run totals, updated from the download threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytesDownloaded = 0
+        self.bytesReused = 0
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call (committed and closed at the end), so the cache can be used from download threads
+        db = sqlite3.connect(self.dbPath, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _count(self, hits=0, misses=0, bytesDownloaded=0, bytesReused=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.bytesDownloaded += bytesDownloaded
+            self.bytesReused += bytesReused
+
+    def tileKey(self, url, headers):
+        version = headers.get("ETag") or headers.get("Content-Length") or ""
+        return hashlib.sha1(f"{url}\n{version}".encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        # Path of the cached tile, or None
+        with self._connect() as db:
+            row = db.execute("SELECT filename, bytes FROM tiles WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(self.cacheDir, row[0])
+            if not os.path.exists(path) or os.path.getsize(path) != row[1]:
+                db.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                return None
+            db.execute("UPDATE tiles SET lastUsed = ? WHERE key = ?", (time.time(), key))
+        return path
+
+    def cached(self, engine, url):
+        # Path of the current version of url if it is already in the cache, otherwise None (nothing is downloaded)
+        path = self.lookup(self.tileKey(url, engine.head(url)))
+        if path is not None:
+            self._count(hits=1, bytesReused=os.path.getsize(path))
+        return path
+
+    def peek(self, url):
+        # Path of the most recently used cached copy of url, without asking the server if it is still current
+        # (for estimates; fetch checks properly)
+        with self._connect() as db:
+            rows = db.execute("SELECT filename, bytes FROM tiles WHERE url = ? ORDER BY lastUsed DESC", (url,)).fetchall()
+        for filename, size in rows:
+            path = os.path.join(self.cacheDir, filename)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                return path
+        return None
+
+    def fetch(self, engine, url, progress=None):
+        # Path of the tile for url, downloading it with engine (a DownloadEngine) if it isn't cached
+        # progress is an optional DownloadProgress to report bytes to
+        headers = engine.head(url)
+        key = self.tileKey(url, headers)
+        if progress is not None and headers.get("Content-Length"):
+            progress.expect(int(headers["Content-Length"]))
+        path = self.lookup(key)
+        if path is not None:
+            self._count(hits=1, bytesReused=os.path.getsize(path))
+            if progress is not None:
+                progress.add(os.path.getsize(path))
+            return path
+
+        # Download under a temp name, then publish with an atomic rename; if another run got there first the
+        # rename just replaces an identical file
+        self._count(misses=1)
+        filename = key + os.path.splitext(url)[1]
+        path = os.path.join(self.cacheDir, filename)
+        fd, tempPath = tempfile.mkstemp(suffix=".part", dir=self.cacheDir)
+        os.close(fd)
+        try:
+            engine.download(url, tempPath, progress.add if progress is not None else None)
+            size = os.path.getsize(tempPath)
+            try:
+                os.replace(tempPath, path)
+            except PermissionError:
+                # Windows won't replace a file another run has open; that copy is just as good
+                if not os.path.exists(path):
+                    raise
+                os.remove(tempPath)
+        except Exception:
+            for leftover in (tempPath, tempPath + ".part", tempPath + ".part.json"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+        self._count(bytesDownloaded=size)
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)", (key, url, filename, size, time.time()))
+        self.evict()
+        return path
+
+    def evict(self):
+        # Remove least recently used tiles until the cache is back under budget
+        with self._connect() as db:
+            total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM tiles").fetchone()[0]
+            if total <= self.maxBytes:
+                return
+            rows = db.execute("SELECT key, filename, bytes FROM tiles WHERE lastUsed < ? ORDER BY lastUsed", (time.time() - inUseSeconds,)).fetchall()
+            for key, filename, size in rows:
+                if total <= self.maxBytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cacheDir, filename))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue    # still open somewhere (Windows won't delete it); try again next time
+                db.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                total -= size
+
+    def summary(self):
+        return f"Tile cache: {self.hits} hits, {self.misses} misses, {self.bytesDownloaded / 1024 ** 2:,.0f} MB downloaded, {self.bytesReused / 1024 ** 2:,.0f} MB reused ({self.cacheDir})"
@@ -0,0 +1,105 @@
+'''
+Picks which of the DEM tiles under an AOI are actually needed
+Where USGS projects overlap, the coverage index has tiles from each of them. Tiles are taken in priority order
+(newest project first, by default) and a tile is only kept if it covers part of the AOI that the tiles before it
+don't, so tiles the "FIRST" merge would have thrown away are never downloaded
+Index footprints are traced from a coarse mask and simplified, so they can reach a little past a tile's data;
+the union of the tiles kept so far is shrunk by footprintSlack before it is taken off the AOI, so the next tile
+still fills the edge of the coverage, while the seams between kept tiles stay covered
+'''
+
+import re
+import math
+from osgeo import ogr, osr
+
+defaultFootprintSlack = 20.0    # meters; how far a footprint may overshoot its tile's data (a coarse mask cell or two)
+defaultMinSliver = 1.0          # square meters; a tile adding less of the AOI than this (one 1m DEM cell) isn't needed
+metersPerDegree = 111320.0
+
+
+def selectTiles(candidates, aoiRings, priority="newest", spatialReferenceWKT=None, footprintSlack=defaultFootprintSlack, minSliver=defaultMinSliver):
+    # candidates: (featureId, project, linkaws, rings) of the tiles intersecting the AOI
+    # aoiRings: a list of ring lists, one per AOI polygon, in the same coordinate system as the tiles
+    # priority: "all" keeps every tile in index order (no selection), "index" prefers tiles in index order,
+    # "newest" prefers the newest project (by the year in its name), or a list of project names in order of
+    # preference, with any projects not listed after them, newest first
+    # spatialReferenceWKT is the coordinate system of the tiles and AOI (meters if not given), for the slack and sliver sizes
+    # Returns (featureId, project, linkaws) of the tiles to use, best first, which is the order to merge them in
+    candidates = sorted(candidates, key=lambda candidate: candidate[0])
+    if priority == "all":
+        return [candidate[:3] for candidate in candidates]
+
+    remaining = None
+    for rings in aoiRings:
+        polygon = ringsGeometry(rings)
+        if polygon is not None:
+            remaining = polygon if remaining is None else remaining.Union(polygon)
+    if remaining is None or remaining.GetArea() == 0:
+        return [candidate[:3] for candidate in candidates]
+    unitsPerMeter = mapUnitsPerMeter(spatialReferenceWKT, remaining)
+    slack = footprintSlack * unitsPerMeter
+    minArea = minSliver * unitsPerMeter ** 2
+
+    aoi = remaining
+    union = None
+    selected = []
+    for featureId, project, link, rings in sorted(candidates, key=priorityKey(priority)):
+        if remaining.IsEmpty():
+            break
+        footprint = ringsGeometry(rings)
+        if footprint is None or not footprint.Intersects(remaining):
+            continue
+        if footprint.Intersection(remaining).GetArea() <= minArea:
+            continue
+        selected.append((featureId, project, link))
+        union = footprint if union is None else union.Union(footprint)
+        covered = union.Buffer(-slack) if slack > 0 else union
+        if covered is not None and not covered.IsEmpty():
+            remaining = aoi.Difference(covered)
+    return selected
+
+
+def mapUnitsPerMeter(spatialReferenceWKT, area):
+    # For geographic coordinates, degrees of longitude per meter at the AOI's latitude (more than of latitude, so
+    # the slack errs towards keeping tiles)
+    if not spatialReferenceWKT:
+        return 1.0
+    sr = osr.SpatialReference()
+    sr.ImportFromWkt(spatialReferenceWKT)
+    if sr.IsGeographic():
+        latitude = area.Centroid().GetY()
+        return 1 / (metersPerDegree * max(math.cos(math.radians(latitude)), 0.01))
+    return 1 / sr.GetLinearUnits()
+
+
+def priorityKey(priority):
+    # Sort key for candidates, best first; ties go to index order
+    if priority == "index":
+        return lambda candidate: candidate[0]
+    if priority == "newest":
+        return lambda candidate: (-projectYear(candidate[1]), candidate[0])
+    ranks = {project: rank for rank, project in enumerate(priority)}
+    return lambda candidate: (ranks.get(candidate[1], len(ranks)), -projectYear(candidate[1]), candidate[0])
+
+
+def projectYear(project):
+    # Collection year from a project name like MO_WestCentral_2018 (the last year in it), or 0 if there isn't one
+    years = re.findall(r"(?<!\d)(?:19|20)\d\d(?!\d)", project or "")
+    return int(years[-1]) if years else 0
+
+
+def ringsGeometry(rings):
+    # OGR polygon from a list of rings, with holes and islands by the even-odd rule (rings don't say which is which)
+    geometry = None
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        linearRing = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ring:
+            linearRing.AddPoint_2D(float(x), float(y))
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(linearRing)
+        if not polygon.IsValid():
+            polygon = polygon.Buffer(0)
+        geometry = polygon if geometry is None else geometry.SymDifference(polygon)
+    return geometry
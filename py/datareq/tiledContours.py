@@ -0,0 +1,236 @@
+'''
+Contour lines of a DEM with gdal.ContourGenerate, run in tiles on a process pool
+Each worker contours its tile plus a margin of cells, then clips the lines to the tile's own rectangle, so
+neighbouring tiles cut the same contour segments at the same place on their shared edge. Lines that don't
+touch a shared edge are finished as soon as their tile is; the rest are joined end to end once every tile is
+in, which gives the same continuous lines (and closed rings) as contouring the whole DEM in one pass
+With a smoothing window, each worker applies the focal mean (and unit scale) to its block as it reads it,
+so the smoothed surface never has to be written out
+With a tolerance, lines are simplified with Douglas-Peucker as they are produced (by the workers, or after
+joining for lines that cross a seam), so the vertex count is cut before anything is held or written
+'''
+
+import os
+import numpy as np
+from osgeo import gdal, ogr
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from focalMean import smoothedBlock, outputNoData
+from poolExecutable import setPoolExecutable    # on sys.path once focalMean is imported
+from footprint import simplifyLine, simplifyRing
+
+defaultTileSize = 4096                              # cells per side of the tiles handed to the workers
+defaultWorkers = max(1, (os.cpu_count() or 2) - 1)
+tileMargin = 2                                      # extra cells read around each tile
+seamTolerance = 1e-6                                # in cells; line ends this close on a shared edge are joined
+
+
+def contourLines(demPath, interval, base=0.0, tileSize=defaultTileSize, workers=defaultWorkers, progress=None, window=0, scale=1.0,
+                 tolerance=0.0, stats=None):
+    # Yields (elevation, (n, 2) array of map coordinates) for every contour line of band 1 of demPath
+    # window > 0 contours the window x window focal mean of the DEM instead, and scale multiplies the
+    # elevations (ie. focalMean.feetPerMeter), both applied by the workers as they read
+    # tolerance (map units) is how far a simplified line may stray from the original; 0 keeps every vertex
+    # Lines come out as they are finished, not in any particular order; progress, if given, is called with
+    # the fraction of tiles done, and stats, if given, is a dict that gets the "verticesIn" and "verticesOut" totals
+    src = gdal.Open(demPath)
+    if src is None:
+        raise IOError(f"GDAL could not open {demPath}")
+    width, height = src.RasterXSize, src.RasterYSize
+    geotransform = src.GetGeoTransform()
+    src = None
+    pixelTolerance = tolerance / max(abs(geotransform[1]), abs(geotransform[5]))
+    stats = {} if stats is None else stats
+    stats["verticesIn"] = stats["verticesOut"] = 0
+
+    # Tile rectangles are in pixel coordinates, where pixel centres are at .5; the outside edges of the
+    # raster get no limit, so nothing is cut there
+    tiles = []
+    for y in range(0, height, tileSize):
+        for x in range(0, width, tileSize):
+            tiles.append((x if x > 0 else -np.inf, y if y > 0 else -np.inf,
+                          x + tileSize if x + tileSize < width else np.inf, y + tileSize if y + tileSize < height else np.inf))
+
+    openLines = defaultdict(list)       # elevation -> lines with an end on a shared edge
+    done = 0
+    setPoolExecutable()
+    with ProcessPoolExecutor(workers) as pool:
+        tileIter = iter(tiles)
+        pending = set()
+        while True:
+            for tile in tileIter:
+                pending.add(pool.submit(contourTile, demPath, tile, interval, base, window, scale, pixelTolerance))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                finishedLines, seamLines, verticesIn = future.result()
+                stats["verticesIn"] += verticesIn
+                for elevation, line in finishedLines:
+                    stats["verticesOut"] += len(line)
+                    yield elevation, pixelsToMap(line, geotransform)
+                for elevation, line in seamLines:
+                    openLines[elevation].append(line)
+                done += 1
+                if progress is not None:
+                    progress(done / len(tiles))
+
+    for elevation, lines in openLines.items():
+        for line in stitchLines(lines):
+            stats["verticesIn"] += len(line)
+            line = simplifyContour(line, pixelTolerance)
+            stats["verticesOut"] += len(line)
+            yield elevation, pixelsToMap(line, geotransform)
+
+
+def contourTile(demPath, tile, interval, base, window=0, scale=1.0, tolerance=0.0):
+    # Runs in the worker processes: contour the tile (with its margin) and clip the lines back to the tile
+    # Returns ([(elevation, line)] finished and simplified, [(elevation, line)] ending on a shared edge, vertices
+    # in the finished lines before simplifying), in pixel coordinates
+    xmin, ymin, xmax, ymax = tile
+    src = gdal.Open(demPath)
+    band = src.GetRasterBand(1)
+    x0 = 0 if xmin == -np.inf else int(xmin) - tileMargin
+    y0 = 0 if ymin == -np.inf else int(ymin) - tileMargin
+    x1 = src.RasterXSize if xmax == np.inf else min(int(xmax) + tileMargin, src.RasterXSize)
+    y1 = src.RasterYSize if ymax == np.inf else min(int(ymax) + tileMargin, src.RasterYSize)
+    if window > 0:
+        values = smoothedBlock(band, x0, y0, x1 - x0, y1 - y0, window, scale)
+        nodata = outputNoData
+    else:
+        values = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        nodata = band.GetNoDataValue()
+        if scale != 1.0:
+            values = np.where(values == nodata, values, values * scale) if nodata is not None else values * scale
+    src = None
+
+    mem = gdal.GetDriverByName("MEM").Create("", x1 - x0, y1 - y0, 1, gdal.GDT_Float64)
+    mem.SetGeoTransform((x0, 1, 0, y0, 0, 1))
+    memBand = mem.GetRasterBand(1)
+    memBand.WriteArray(values)
+    if nodata is not None:
+        memBand.SetNoDataValue(nodata)
+    layerDS = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = layerDS.CreateLayer("contours")
+    layer.CreateField(ogr.FieldDefn("elev", ogr.OFTReal))
+    gdal.ContourGenerate(memBand, float(interval), float(base), [], 1 if nodata is not None else 0, nodata or 0, layer, -1, 0)
+
+    finished = []
+    seams = []
+    verticesIn = 0
+    for feature in layer:
+        elevation = feature.GetField(0)
+        geometry = feature.GetGeometryRef()
+        line = np.array(geometry.GetPoints(), dtype=float)[:, :2]
+        for piece in clipLine(line, xmin, ymin, xmax, ymax):
+            if onSeam(piece[0], tile) or onSeam(piece[-1], tile):
+                seams.append((elevation, piece))
+            else:
+                verticesIn += len(piece)
+                finished.append((elevation, simplifyContour(piece, tolerance)))
+    layerDS = None
+    mem = None
+    return finished, seams, verticesIn
+
+
+def simplifyContour(line, tolerance):
+    # Douglas-Peucker, keeping both ends of open lines and the ring shape of closed ones
+    if tolerance <= 0 or len(line) < 3:
+        return line
+    if np.array_equal(line[0], line[-1]):
+        return simplifyRing(line, tolerance)
+    return simplifyLine(line, tolerance)
+
+
+def clipLine(line, xmin, ymin, xmax, ymax):
+    # Liang-Barsky on every segment at once; returns the pieces of line inside the rectangle, which is
+    # closed on its low sides and open on its high sides, so a segment lying along a shared edge only
+    # belongs to one tile
+    p0, p1 = line[:-1], line[1:]
+    delta = p1 - p0
+    t0 = np.zeros(len(p0))
+    t1 = np.ones(len(p0))
+    for axis, low, high in ((0, xmin, xmax), (1, ymin, ymax)):
+        start, d = p0[:, axis], delta[:, axis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta = (low - start) / d
+            tb = (high - start) / d
+        inside = (start >= low) & (start < high)
+        t0 = np.maximum(t0, np.where(d == 0, np.where(inside, -np.inf, np.inf), np.minimum(ta, tb)))
+        t1 = np.minimum(t1, np.where(d == 0, np.where(inside, np.inf, -np.inf), np.maximum(ta, tb)))
+    keep = t0 < t1
+    if keep.all():
+        return [line]
+
+    pieces = []
+    piece = None
+    for i in np.flatnonzero(keep):
+        a = p0[i] + t0[i] * delta[i]
+        b = p0[i] + t1[i] * delta[i]
+        if piece is not None and lastKept == i - 1 and t1[i - 1] == 1 and t0[i] == 0:
+            piece.append(b)
+        else:
+            if piece is not None:
+                pieces.append(np.array(piece))
+            piece = [a, b]
+        lastKept = i
+    if piece is not None:
+        pieces.append(np.array(piece))
+
+    # A closed ring cut once comes out as two pieces that meet where the ring started
+    if len(pieces) > 1 and np.array_equal(line[0], line[-1]) and keep[0] and keep[-1] and t0[0] == 0 and t1[-1] == 1:
+        pieces[0] = np.vstack([pieces.pop()[:-1], pieces[0]])
+    return pieces
+
+
+def onSeam(point, tile):
+    # Whether point lies on one of the tile's shared edges (its outer raster edges are infinite)
+    xmin, ymin, xmax, ymax = tile
+    x, y = point
+    return min(abs(x - xmin), abs(x - xmax), abs(y - ymin), abs(y - ymax)) <= seamTolerance
+
+
+def stitchLines(lines):
+    # Join lines of one elevation whose ends meet, reversing them where needed; returns the joined lines
+    def key(point):
+        return tuple(np.round(point / seamTolerance).astype(np.int64))
+
+    ends = defaultdict(list)    # end key -> indices of the lines ending (or starting) there
+    for i, line in enumerate(lines):
+        ends[key(line[0])].append(i)
+        ends[key(line[-1])].append(i)
+
+    used = np.zeros(len(lines), dtype=bool)
+
+    def extend(chain, point):
+        # Keep adding the unused line that continues from point; returns the chain's new end point
+        while True:
+            candidates = [j for j in ends[key(point)] if not used[j]]
+            if not candidates:
+                return point
+            j = candidates[0]
+            used[j] = True
+            line = lines[j] if key(lines[j][0]) == key(point) else lines[j][::-1]
+            chain.append(line[1:])
+            point = line[-1]
+
+    joined = []
+    for i, line in enumerate(lines):
+        if used[i]:
+            continue
+        used[i] = True
+        forward = [line]
+        extend(forward, line[-1])
+        backward = [line[::-1]]
+        extend(backward, line[0])
+        pieces = [piece[::-1] for piece in reversed(backward[1:])] + forward
+        joined.append(np.vstack(pieces))
+    return joined
+
+
+def pixelsToMap(line, geotransform):
+    xs = geotransform[0] + line[:, 0] * geotransform[1] + line[:, 1] * geotransform[2]
+    ys = geotransform[3] + line[:, 0] * geotransform[4] + line[:, 1] * geotransform[5]
+    return np.column_stack([xs, ys])
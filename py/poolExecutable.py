@@ -0,0 +1,15 @@
+'''
+Process pool setup shared by the tools that run work on a pool (focalMean and tiledContours in datareq,
+clipRasterDirectory in raster); the tool folders add this folder to sys.path to import it
+'''
+
+import os
+import sys
+import multiprocessing
+
+
+def setPoolExecutable():
+    # Inside ArcGIS Pro sys.executable is ArcGISPro.exe; the worker processes have to be started with the
+    # environment's own Python instead
+    if os.path.basename(sys.executable).lower() == "arcgispro.exe":
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
@@ -3,17 +3,51 @@ Geoprocessing Tool which builds clips and exports a single raster
 Additional options provided based on past projects
 '''
 
+clipEngine = "fused"        # "fused": one GDAL pass over the geometry's window of the raster, with the clip mask and the
+                            # white remaps applied block by block, written straight to the output (for rasters GDAL reads)
+                            # "arcpy": Clip, gdal.Translate and Con to scratch rasters, then exportRaster
+
 import arcpy
 import os
+import shutil
+import tempfile
+from datetime import datetime
 from osgeo import gdal
-from exportRaster import exportRaster
+from exportRaster import exportRaster, parseFormats
+from fusedClip import fusedClip
+
+# Output formats the fused engine writes itself: GDAL driver and creation options
+# (LZ77 in ArcGIS is Deflate; the JP2 is copied from a scratch TIFF written next to it, as JP2KAK can't be written block by block)
+directFormats = {
+    "TIFF (LZ77 compression)": ("GTiff", ["COMPRESS=DEFLATE", "TILED=YES", "BIGTIFF=IF_SAFER"]),
+    "JP2 (GDAL - Faster)": ("JP2KAK", ["QUALITY=100"]),
+}
+stagingOptions = ["TILED=YES", "BIGTIFF=IF_SAFER"]   # the scratch TIFF for exportRaster: uncompressed, so it decodes cheaply
 
 def clipRaster(inputRaster, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, outFile):
-    
+    # Intermediate rasters go in a folder of their own, so runs (and clipRasterDirectory's workers) never share scratch files
+    scratchDir = newScratchDir()
+    try:
+        rasterPath = arcpy.Describe(inputRaster).catalogPath
+        if clipEngine == "fused" and gdal.Open(rasterPath) is not None:
+            fusedClipRaster(rasterPath, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, outFile, scratchDir)
+        else:
+            if clipEngine == "fused":
+                arcpy.AddMessage(f"GDAL can't read {inputRaster}; clipping with ArcGIS instead")
+            arcpyClipRaster(inputRaster, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, outFile, scratchDir)
+    finally:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+
+
+def newScratchDir():
+    return tempfile.mkdtemp(prefix="clip_", dir=arcpy.env.scratchFolder)
+
+
+def arcpyClipRaster(inputRaster, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, outFile, scratchDir):
     # Clip Raster; if bNoDataToWhite, set nodata as 255 (try this with clip and Con)
     arcpy.SetProgressor("default", f"Clipping Raster...")
     arcpy.AddMessage("Clipping Raster...")
-    clippedRasterFile = os.path.join(arcpy.env.scratchFolder, "clipped_raster.tif")
+    clippedRasterFile = os.path.join(scratchDir, "clipped_raster.tif")
     arcpy.env.compression = "LZW"
     arcpy.management.Clip(inputRaster, "", clippedRasterFile, inputGeometry, "255", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
 
@@ -22,7 +56,7 @@ def clipRaster(inputRaster, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite,
         arcpy.SetProgressor("default", f"Converting no data to white...")
         arcpy.AddMessage("Converting no data to white...")
         # Use GDAL to remove the no data from the TIF, so that it shows as white
-        gdalRasterFile = os.path.join(arcpy.env.scratchFolder, "gdal_raster.tif")
+        gdalRasterFile = os.path.join(scratchDir, "gdal_raster.tif")
         gFile = gdal.Open(clippedRasterFile)
         gdal.Translate(gdalRasterFile, gFile, format="GTiff", noData="none", creationOptions=["COMPRESS=LZW"])
         gFile = None    # Close dataset (important)
@@ -33,7 +67,7 @@ def clipRaster(inputRaster, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite,
     if bBlackPixelsToWhite:
         arcpy.SetProgressor("default", f"Converting black pixels to white...")
         arcpy.AddMessage("Converting black pixels to white...")
-        b2wRasterFile = os.path.join(arcpy.env.scratchFolder, "b2w_raster.tif")        
+        b2wRasterFile = os.path.join(scratchDir, "b2w_raster.tif")        
         conRaster = arcpy.ia.Con(gdalRasterFile, 255, gdalRasterFile, "VALUE = 0")
         conRaster.save(b2wRasterFile)
     else:
@@ -54,6 +88,52 @@ def clipRaster(inputRaster, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite,
     arcpy.AddMessage("Success!")
 
 
+def fusedClipRaster(rasterPath, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, outFile, scratchDir):
+    # Measure speed
+    start = datetime.now()
+
+    arcpy.SetProgressor("default", f"Clipping Raster...")
+    arcpy.AddMessage("Clipping Raster...")
+    geometries = geometryWKTs(inputGeometry, arcpy.Describe(rasterPath).spatialReference)
+
+    # Formats GDAL can't write (ArcGIS JP2), and several formats at once, go through one scratch TIFF and exportRaster
+    formats = parseFormats(outputFormat)
+    direct = len(formats) == 1 and formats[0] in directFormats
+    target = outFile if direct else os.path.join(scratchDir, "clipped_raster.tif")
+    driver, options = outputDriver(formats)
+    if fusedClip(rasterPath, geometries, bNoDataToWhite, bBlackPixelsToWhite, target, driver, options) is None:
+        arcpy.AddWarning(f"The clip geometry doesn't overlap {rasterPath}; nothing written")
+        return
+
+    if direct:
+        if bBuildPyramids:
+            arcpy.management.BuildPyramids(outFile)
+        aprx = arcpy.mp.ArcGISProject("CURRENT")
+        aprx.activeMap.addDataFromPath(outFile)
+        arcpy.AddMessage(f"Clipped and exported {outFile} in {datetime.now() - start}")
+    else:
+        arcpy.SetProgressor("default", f"Saving {outFile}")
+        arcpy.AddMessage(f"Saving {outFile}")
+        exportRaster(target, bBuildPyramids, outputFormat, outFile)
+        arcpy.management.Delete(target)
+
+    arcpy.AddMessage("Success!")
+
+
+def outputDriver(formats):
+    # GDAL driver and creation options the fused engine writes with: the format itself if just one is asked for
+    # and it is written directly, otherwise the scratch TIFF exportRaster works from
+    if len(formats) == 1 and formats[0] in directFormats:
+        return directFormats[formats[0]]
+    return "GTiff", stagingOptions
+
+
+def geometryWKTs(inputGeometry, spatialReference):
+    # WKT of the clip polygons, in the raster's coordinate system
+    with arcpy.da.SearchCursor(inputGeometry, ["SHAPE@WKT"], spatial_reference=spatialReference) as cursor:
+        return [row[0] for row in cursor if row[0]]
+
+
 # This is used to execute code if the file was run but not imported
 if __name__ == '__main__':
 
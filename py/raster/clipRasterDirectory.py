@@ -3,12 +3,30 @@ Geoprocessing Tool which builds clips and exports a single raster
 Additional options provided based on past projects
 '''
 
-import arcpy
+clipWorkers = 0         # rasters clipped at the same time, each in its own process (fused engine); 0 is one per core, less one
+manifestName = "clipManifest.json"  # kept in the output directory; re-runs only redo the rasters whose inputs have changed
+
+# arcpy, and clipRaster and exportRaster which load it, are imported where they are used: under spawn the pool's
+# worker processes re-import this script, and all they need from it is fusedClip
 import os
-from osgeo import gdal
-from clipRaster import clipRaster
+import sys
+import time
+import shutil
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from fusedClip import clipTask, classifyRaster, footprintPart
+from runManifest import RunManifest, fileSignature, digest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from poolExecutable import setPoolExecutable
 
 def clipRasterDirectory(inputDirectory, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, outputDirectory):
+    import arcpy
+    from clipRaster import clipRaster, clipEngine, directFormats, outputDriver, geometryWKTs, newScratchDir
+    from exportRaster import exportRaster, exportOutputs, parseFormats
+
+    # Measure speed
+    start = time.perf_counter()
+
     # Get list of rasters in inputDirectory
     arcpy.env.workspace = inputDirectory
     rasters = arcpy.ListRasters("*", "All")
@@ -20,16 +38,130 @@ def clipRasterDirectory(inputDirectory, inputGeometry, bNoDataToWhite, bBlackPix
         arcpy.AddMessage(f"Creating {outputDirectory}")
         os.mkdir(outputDirectory)
 
-    i = 1
-    for raster in rasters:
-        arcpy.SetProgressor("default", f"{i}/{rasterCount}: Clipping {raster}")
-        arcpy.AddMessage(f"{i}/{rasterCount}: Clipping {raster}")
+    # What the last run into outputDirectory built, and from what
+    manifest = RunManifest(os.path.join(outputDirectory, manifestName), {
+        "tool": "clipRasterDirectory", "clipEngine": clipEngine, "bNoDataToWhite": bool(bNoDataToWhite),
+        "bBlackPixelsToWhite": bool(bBlackPixelsToWhite), "bBuildPyramids": bool(bBuildPyramids), "outputFormat": outputFormat,
+    })
 
+    # Check each raster's footprint against the clip polygons from its header: rasters outside them are skipped,
+    # and ones wholly inside are copied without a mask. Rasters GDAL can't read (None) go through clipRaster here,
+    # one at a time; the rest are clipped on the process pool
+    # The clip polygons are read once for each coordinate system the rasters are in
+    # Each raster's signature covers its file and the part of the clip polygons over it (all of them, for ArcGIS),
+    # so a revised AOI only redoes the rasters it changes
+    geometries = {}
+    relations = {}
+    signatures = {}
+    arcpy.SetProgressor("default", f"Checking raster footprints...")
+    wholeGeometry = None
+    for raster in rasters:
         rInPath = os.path.join(inputDirectory, raster)
-        rOutPath = os.path.join(outputDirectory, raster)
+        relations[raster] = None
+        if clipEngine == "fused":
+            sr = arcpy.Describe(rInPath).spatialReference
+            srKey = sr.exportToString()
+            if srKey not in geometries:
+                geometries[srKey] = geometryWKTs(inputGeometry, sr)
+            relation = classifyRaster(rInPath, geometries[srKey])
+            if relation is not None:
+                relations[raster] = (relation, srKey)
+                signatures[raster] = digest(fileSignature(rInPath), footprintPart(rInPath, geometries[srKey]))
+                continue
+        if wholeGeometry is None:
+            wholeGeometry = digest(*geometryWKTs(inputGeometry, None))
+        signatures[raster] = digest(fileSignature(rInPath), wholeGeometry)
+    counts = Counter(relation[0] if relation else "ArcGIS" for relation in relations.values())
+    workers = clipWorkers or max(1, (os.cpu_count() or 2) - 1)
+    arcpy.AddMessage(f"{counts['partial']} rasters to clip, {counts['inside']} wholly inside the clip geometry, "
+                     f"{counts['outside']} outside it (skipped), {counts['ArcGIS']} to clip with ArcGIS; {workers} workers")
+
+    formats = parseFormats(outputFormat)
+    direct = len(formats) == 1 and formats[0] in directFormats
+    driver, options = outputDriver(formats)
+    timings = []
+    failed = []
+    reused = []
+    setPoolExecutable()
+    with ProcessPoolExecutor(workers) as pool:
+        # Each task gets its own scratch folder (only used when the output goes through exportRaster)
+        jobs = []
+        for raster in rasters:
+            rInPath = os.path.join(inputDirectory, raster)
+            rOutPath = os.path.join(outputDirectory, raster)
+            if relations[raster] is not None and relations[raster][0] == "outside":
+                continue
+            if manifest.reusable(raster, signatures[raster]):
+                manifest.keep(raster)
+                reused.append(raster)
+                continue
+            for output in exportOutputs(outputFormat, rOutPath):
+                if arcpy.Exists(output):
+                    arcpy.management.Delete(output)
+            if relations[raster] is None:
+                jobs.append((raster, rInPath, rOutPath, None, None))
+                continue
+            relation, srKey = relations[raster]
+            scratchDir = None if direct else newScratchDir()
+            target = rOutPath if direct else os.path.join(scratchDir, "clipped_raster.tif")
+            jobs.append((raster, rInPath, rOutPath, scratchDir, pool.submit(clipTask, rInPath, geometries[srKey], bNoDataToWhite, bBlackPixelsToWhite, target, driver, options, relation)))
+
+        if reused:
+            arcpy.AddMessage(f"{len(reused)} rasters are unchanged since the last run; reusing their outputs")
+
+        # Results are taken (and reported) in the order of the input, whichever finishes first
+        arcpy.SetProgressor("step", f"Clipping {len(jobs)} rasters...", 0, len(jobs), 1)
+        for i, (raster, rInPath, rOutPath, scratchDir, future) in enumerate(jobs, 1):
+            arcpy.SetProgressorLabel(f"{i}/{len(jobs)}: Clipping {raster}")
+            taskStart = time.perf_counter()
+            try:
+                if future is None:
+                    clipRaster(rInPath, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, rOutPath)
+                    seconds = time.perf_counter() - taskStart
+                else:
+                    result, seconds = future.result()
+                    taskStart = time.perf_counter()
+                    if result is None:
+                        arcpy.AddMessage(f"{i}/{len(jobs)}: {raster} doesn't overlap the clip geometry; nothing written")
+                        arcpy.SetProgressorPosition(i)
+                        continue
+                    if direct:
+                        if bBuildPyramids:
+                            arcpy.management.BuildPyramids(rOutPath)
+                        aprx = arcpy.mp.ArcGISProject("CURRENT")
+                        aprx.activeMap.addDataFromPath(rOutPath)
+                    else:
+                        exportRaster(result, bBuildPyramids, outputFormat, rOutPath)
+                    seconds += time.perf_counter() - taskStart
+            except Exception as e:
+                arcpy.AddWarning(f"{i}/{len(jobs)}: Could not clip {raster}: {e}")
+                failed.append(raster)
+            else:
+                manifest.record(raster, signatures[raster], exportOutputs(outputFormat, rOutPath))
+                timings.append((seconds, raster))
+                arcpy.AddMessage(f"{i}/{len(jobs)}: Clipped {raster} in {seconds:.1f}s")
+            finally:
+                if scratchDir is not None:
+                    shutil.rmtree(scratchDir, ignore_errors=True)
+            arcpy.SetProgressorPosition(i)
+    arcpy.ResetProgressor()
+
+    # Outputs of the last run that no longer have an input (or are now outside the clip geometry)
+    stale = [output for output in manifest.staleOutputs() if arcpy.Exists(output)]
+    for output in stale:
+        arcpy.management.Delete(output)
+    manifest.save()
+    arcpy.AddMessage(f"{len(timings)} outputs built, {len(reused)} reused from the last run, {len(stale)} out of date ones removed")
 
-        clipRaster(rInPath, inputGeometry, bNoDataToWhite, bBlackPixelsToWhite, bBuildPyramids, outputFormat, rOutPath)
-        i += 1
+    # Timings over the whole directory
+    elapsed = time.perf_counter() - start
+    if timings:
+        busy = sum(seconds for seconds, _ in timings)
+        slowest, slowestRaster = max(timings)
+        arcpy.AddMessage(f"Clipped {len(timings)} rasters in {elapsed:.1f}s: {busy:.1f}s of work ({busy / elapsed:.1f}x in parallel), "
+                         f"{busy / len(timings):.1f}s each on average, slowest {slowestRaster} ({slowest:.1f}s)")
+    if failed:
+        arcpy.AddWarning(f"{len(failed)} rasters could not be clipped: {', '.join(failed)}")
 
 
     arcpy.AddMessage("Success!")
@@ -38,6 +170,7 @@ def clipRasterDirectory(inputDirectory, inputGeometry, bNoDataToWhite, bBlackPix
 
 # This is used to execute code if the file was run but not imported
 if __name__ == '__main__':
+    import arcpy
 
     # Tool parameter accessed with GetParameter or GetParameterAsText
     inputDirectory = arcpy.GetParameterAsText(0)
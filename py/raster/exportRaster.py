@@ -1,14 +1,35 @@
 '''
 Geoprocessing Tool which exports a single raster to a selection of output formats.
 Option to output nodata pixels as white.
+Several formats can be asked for at once ("TIFF (LZ77 compression);COG"): the source is then decoded once, and
+the encoders for each format all work from that copy at the same time
 '''
 
 import arcpy
 from osgeo import gdal
 import os
-from datetime import datetime
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+# GDAL driver, creation options and file ending of the formats the GDAL encoders write
+# (LZ77 in ArcGIS is Deflate; JP2KAK is the only JP2 codec that works in ArcGIS GDAL module; COGs carry their own overviews)
+gdalFormats = {
+    "TIFF (LZ77 compression)": ("GTiff", ["COMPRESS=DEFLATE", "TILED=YES", "BIGTIFF=IF_SAFER"], ".tif"),
+    "JP2 (GDAL - Faster)": ("JP2KAK", ["QUALITY=100"], ".jp2"),
+    "COG": ("COG", ["COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"], "_cog.tif"),
+}
 
 def exportRaster(inputRaster, bBuildPyramids, outputFormat, outFile):
+    # outputFormat may list several formats; each gets outFile with its own ending (see exportOutputs)
+    formats = parseFormats(outputFormat)
+    if fanOut(formats):
+        exportRasterFormats(inputRaster, bBuildPyramids, formats, outFile)
+        return
+    # A single format, without the quotes a multivalue parameter may have put around it
+    outputFormat = formats[0]
+
     # Measure speed
     start = datetime.now()
 
@@ -39,9 +60,10 @@ def exportRaster(inputRaster, bBuildPyramids, outputFormat, outFile):
 
 
     if outputFormat == "JP2 (GDAL - Faster)":
-        # Save to file so GDAL can work with it
+        # Save to file so GDAL can work with it (in a folder of its own, as several exports can run at once)
         workingRaster = arcpy.Raster(inputRaster)
-        workingRasterFile = os.path.join(arcpy.env.scratchFolder, "tempRaster.tif")
+        workingDir = tempfile.mkdtemp(prefix="export_", dir=arcpy.env.scratchFolder)
+        workingRasterFile = os.path.join(workingDir, "tempRaster.tif")
         workingRaster.save(workingRasterFile)
 
         # Process with GDAL
@@ -52,6 +74,7 @@ def exportRaster(inputRaster, bBuildPyramids, outputFormat, outFile):
 
         # Remove temp file
         arcpy.management.Delete(workingRasterFile)
+        shutil.rmtree(workingDir, ignore_errors=True)
 
     
 
@@ -69,6 +92,108 @@ def exportRaster(inputRaster, bBuildPyramids, outputFormat, outFile):
     arcpy.AddMessage("Success!")
 
 
+def exportRasterFormats(inputRaster, bBuildPyramids, formats, outFile):
+    # Measure speed
+    start = datetime.now()
+    outputs = formatOutputs(formats, outFile)
+    arcpy.SetProgressor("default", f"Exporting to {len(outputs)} formats...")
+    arcpy.AddMessage(f"Exporting to {', '.join(outputs.values())}...")
+
+    # Decode the source once, to an uncompressed TIFF every encoder can read cheaply (named for the output, so
+    # ArcGIS's JP2 comes out with the right name); a single GDAL format can be encoded straight from the source
+    workingDir = tempfile.mkdtemp(prefix="export_", dir=arcpy.env.scratchFolder)
+    sourceFile = arcpy.Describe(inputRaster).catalogPath
+    readable = gdal.Open(sourceFile) is not None
+    try:
+        if len(outputs) > 1 or not readable or "JP2 (ArcGIS - Max Quality)" in outputs:
+            stagingFile = os.path.join(workingDir, os.path.splitext(os.path.basename(outFile))[0] + ".tif")
+            decodeStart = datetime.now()
+            if readable:
+                gdal.Translate(stagingFile, sourceFile, format="GTiff", creationOptions=["TILED=YES", "BIGTIFF=IF_SAFER"])
+            else:
+                arcpy.Raster(inputRaster).save(stagingFile)
+            arcpy.AddMessage(f"Decoded {inputRaster} in {datetime.now() - decodeStart}")
+        else:
+            stagingFile = sourceFile
+
+        # GDAL encoders run on threads (GDAL lets go of the GIL); ArcGIS's JP2 runs here meanwhile
+        with ThreadPoolExecutor(len(outputs)) as executor:
+            futures = {outputFormat: executor.submit(gdalEncode, stagingFile, outputFormat, outputFile)
+                       for outputFormat, outputFile in outputs.items() if outputFormat in gdalFormats}
+            timings = {}
+            if "JP2 (ArcGIS - Max Quality)" in outputs:
+                encodeStart = datetime.now()
+                arcpyEncodeJP2(stagingFile, outputs["JP2 (ArcGIS - Max Quality)"])
+                timings["JP2 (ArcGIS - Max Quality)"] = datetime.now() - encodeStart
+            for outputFormat, future in futures.items():
+                timings[outputFormat] = future.result()
+    finally:
+        shutil.rmtree(workingDir, ignore_errors=True)
+
+    for outputFormat, outputFile in outputs.items():
+        # If bBuildPyramids... build pyramids (a COG has its own)
+        if bBuildPyramids and outputFormat != "COG":
+            arcpy.management.BuildPyramids(outputFile)
+
+        # Add to Map
+        aprx = arcpy.mp.ArcGISProject("CURRENT")
+        aprx.activeMap.addDataFromPath(outputFile)
+        arcpy.AddMessage(f"Encoded {outputFile} ({outputFormat}) in {timings[outputFormat]}")
+
+    # End and message
+    end = datetime.now()
+    arcpy.AddMessage(f"Exported {len(outputs)} formats in {end - start} (encoding one after another would have taken {sum(timings.values(), timedelta())})")
+    arcpy.AddMessage("Success!")
+
+
+def gdalEncode(sourceFile, outputFormat, outFile):
+    # Runs on the encoder threads; returns how long it took
+    start = datetime.now()
+    driver, options, _ = gdalFormats[outputFormat]
+    gdal.Translate(outFile, sourceFile, format=driver, noData="none" if driver == "JP2KAK" else None, creationOptions=options)
+    return datetime.now() - start
+
+
+def arcpyEncodeJP2(sourceFile, outFile):
+    outDir = os.path.dirname(outFile)
+    arcpy.env.compression = "JPEG2000 100"
+    arcpy.conversion.RasterToOtherFormat(sourceFile, outDir, "JP2000")
+
+    # Rename output file
+    outFilePath = os.path.join(outDir, os.path.splitext(os.path.basename(sourceFile))[0] + '.jp2')
+    if os.path.normcase(outFilePath) != os.path.normcase(outFile):
+        arcpy.management.Rename(outFilePath, outFile)
+
+
+def exportOutputs(outputFormat, outFile):
+    # The files exportRaster writes for outputFormat and outFile
+    formats = parseFormats(outputFormat)
+    return list(formatOutputs(formats, outFile).values()) if fanOut(formats) else [outFile]
+
+
+def fanOut(formats):
+    return len(formats) > 1 or formats[0] == "COG"
+
+
+def parseFormats(outputFormat):
+    # A multivalue parameter comes as "'TIFF (LZ77 compression)';'JP2 (GDAL - Faster)'"
+    return [value.strip().strip("'") for value in outputFormat.split(";") if value.strip()]
+
+
+def formatOutputs(formats, outFile):
+    # {format: output file}: outFile's name with each format's ending (both JP2s together keep them apart with _gdal)
+    base = os.path.splitext(outFile)[0]
+    outputs = {}
+    for outputFormat in formats:
+        if outputFormat == "JP2 (ArcGIS - Max Quality)":
+            outputs[outputFormat] = base + ".jp2"
+        elif outputFormat == "JP2 (GDAL - Faster)" and "JP2 (ArcGIS - Max Quality)" in formats:
+            outputs[outputFormat] = base + "_gdal.jp2"
+        else:
+            outputs[outputFormat] = base + gdalFormats[outputFormat][2]
+    return outputs
+
+
 # This is used to execute code if the file was run but not imported
 if __name__ == '__main__':
 
@@ -0,0 +1,191 @@
+'''
+Clip of a raster to polygons in one GDAL pass, for clipRaster and the clipRasterDirectory workers
+Only the window of the raster under the polygons is read, a strip at a time; the clip mask is rasterized for
+each strip, and the nodata-to-white and black-to-white remaps are applied to it with NumPy before it is written
+straight to the output, so memory use stays about one strip however large the window
+Uses GDAL and NumPy only (no arcpy), so it can run in worker processes
+The raster's footprint is checked against the polygons first, from its header alone: rasters outside them are
+skipped, and rasters wholly inside them skip the mask (or are just transcoded, if there is nothing to remap)
+'''
+
+import os
+import math
+import time
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+stripBytes = 64 * 1024 * 1024   # roughly how much of the raster is read at once
+
+
+def fusedClip(rasterPath, geometries, bNoDataToWhite, bBlackPixelsToWhite, outFile, driver="GTiff", options=(), relation=None):
+    # Reads just the window of rasterPath under the geometries (WKT, in the raster's coordinate system), a strip
+    # at a time; cells outside the geometries or with no data become 255 (nodata unless bNoDataToWhite), and with
+    # bBlackPixelsToWhite 0 becomes 255 too. Returns outFile, or None if the geometries miss the raster
+    # relation is what classifyRaster gave for the raster, if that has been run already
+    src = gdal.Open(rasterPath)
+    if src is None:
+        raise IOError(f"GDAL could not open {rasterPath}")
+    geotransform = src.GetGeoTransform()
+    ogrGeometries = [ogr.CreateGeometryFromWkt(wkt) for wkt in geometries]
+    relation = relation or footprintRelation(src, ogrGeometries)
+    bandCount = src.RasterCount
+    nodata = [src.GetRasterBand(b).GetNoDataValue() for b in range(1, bandCount + 1)]
+    if relation == "outside":
+        return None
+    if relation == "inside":
+        # Every cell is kept; with no values to change the raster is just copied to the output format
+        if not bBlackPixelsToWhite and all(value is None or value == 255 for value in nodata):
+            gdal.Translate(outFile, src, format=driver, creationOptions=list(options), noData="none" if bNoDataToWhite else 255)
+            src = None
+            return outFile
+        window = (0, 0, src.RasterXSize, src.RasterYSize)
+    else:
+        window = geometryWindow(ogrGeometries, geotransform, src.RasterXSize, src.RasterYSize)
+        if window is None:
+            return None
+    x0, y0, width, height = window
+    windowTransform = (geotransform[0] + x0 * geotransform[1] + y0 * geotransform[2], geotransform[1], geotransform[2],
+                       geotransform[3] + x0 * geotransform[4] + y0 * geotransform[5], geotransform[4], geotransform[5])
+    clipLayer = maskLayer(ogrGeometries, src.GetProjection()) if relation == "partial" else None
+
+    # GTiff is written block by block; other drivers (JP2KAK can only CreateCopy) get a scratch GTiff next to the
+    # output, copied into them at the end
+    dataType = src.GetRasterBand(1).DataType
+    streaming = driver == "GTiff"
+    target = outFile if streaming else os.path.splitext(outFile)[0] + "_strips.tif"
+    out = gdal.GetDriverByName("GTiff").Create(target, width, height, bandCount, dataType,
+                                               list(options) if streaming else ["TILED=YES", "BIGTIFF=IF_SAFER"])
+    out.SetGeoTransform(windowTransform)
+    out.SetProjection(src.GetProjection())
+    for b in range(1, bandCount + 1):
+        srcBand, outBand = src.GetRasterBand(b), out.GetRasterBand(b)
+        outBand.SetColorInterpretation(srcBand.GetColorInterpretation())
+        if srcBand.GetColorTable() is not None:
+            outBand.SetColorTable(srcBand.GetColorTable())
+        if not bNoDataToWhite:
+            outBand.SetNoDataValue(255)
+
+    stripRows = max(1, stripBytes // max(width * bandCount * gdal.GetDataTypeSize(dataType) // 8, 1))
+    for y in range(0, height, stripRows):
+        rows = min(stripRows, height - y)
+        data = src.ReadAsArray(x0, y0 + y, width, rows).reshape(bandCount, rows, width)
+        inside = (stripMask(clipLayer, src.GetProjection(), windowTransform, y, width, rows) if clipLayer is not None
+                  else np.ones((rows, width), dtype=bool))
+        for b in range(bandCount):
+            keep = inside if nodata[b] is None else inside & (data[b] != nodata[b])
+            band = np.where(keep, data[b], 255).astype(data.dtype)
+            if bBlackPixelsToWhite:
+                band[band == 0] = 255
+            out.GetRasterBand(b + 1).WriteArray(band, 0, y)
+
+    if not streaming:
+        gdal.GetDriverByName(driver).CreateCopy(outFile, out, options=list(options))
+        out = None
+        gdal.GetDriverByName("GTiff").Delete(target)
+    out = None
+    clipLayer = None
+    src = None
+    return outFile
+
+
+def clipTask(rasterPath, geometries, bNoDataToWhite, bBlackPixelsToWhite, outFile, driver="GTiff", options=(), relation=None):
+    # Runs in the worker processes: fusedClip, timed; returns (outFile or None, seconds)
+    start = time.perf_counter()
+    result = fusedClip(rasterPath, geometries, bNoDataToWhite, bBlackPixelsToWhite, outFile, driver, options, relation)
+    return result, time.perf_counter() - start
+
+
+def classifyRaster(rasterPath, geometries):
+    # "outside", "inside" or "partial": where rasterPath's footprint lies against the geometries (WKT, in the
+    # raster's coordinate system), from its header alone; None if GDAL can't open it
+    src = gdal.Open(rasterPath)
+    if src is None:
+        return None
+    relation = footprintRelation(src, [ogr.CreateGeometryFromWkt(wkt) for wkt in geometries])
+    src = None
+    return relation
+
+
+def footprintRelation(src, geometries):
+    footprint = rasterFootprint(src)
+    area = unionGeometry(geometries)
+    if area is None or not area.Intersects(footprint):
+        return "outside"
+    if area.Contains(footprint):
+        return "inside"
+    return "partial"
+
+
+def footprintPart(rasterPath, geometries):
+    # WKT of the part of the geometries over rasterPath's footprint ("" if none), from its header alone; everything
+    # a clip of the raster depends on, so a changed clip geometry only matters to the rasters it changes under
+    src = gdal.Open(rasterPath)
+    if src is None:
+        return None
+    area = unionGeometry([ogr.CreateGeometryFromWkt(wkt) for wkt in geometries])
+    part = area.Intersection(rasterFootprint(src)) if area is not None else None
+    src = None
+    return part.ExportToWkt() if part is not None and not part.IsEmpty() else ""
+
+
+def rasterFootprint(src):
+    geotransform = src.GetGeoTransform()
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for px, py in ((0, 0), (src.RasterXSize, 0), (src.RasterXSize, src.RasterYSize), (0, src.RasterYSize), (0, 0)):
+        ring.AddPoint_2D(geotransform[0] + px * geotransform[1] + py * geotransform[2],
+                         geotransform[3] + px * geotransform[4] + py * geotransform[5])
+    footprint = ogr.Geometry(ogr.wkbPolygon)
+    footprint.AddGeometry(ring)
+    return footprint
+
+
+def unionGeometry(geometries):
+    area = None
+    for geometry in geometries:
+        if geometry is None or geometry.IsEmpty():
+            continue
+        area = geometry.Clone() if area is None else area.Union(geometry)
+    return area
+
+
+def geometryWindow(geometries, geotransform, rasterWidth, rasterHeight):
+    # (x, y, width, height) of the cells under the geometries' bounding box, or None if it misses the raster
+    # (assumes a north-up raster, which orthophotos are)
+    envelopes = [geometry.GetEnvelope() for geometry in geometries if geometry is not None and not geometry.IsEmpty()]
+    if not envelopes:
+        return None
+    minX, maxX = min(e[0] for e in envelopes), max(e[1] for e in envelopes)
+    minY, maxY = min(e[2] for e in envelopes), max(e[3] for e in envelopes)
+    x0 = max(0, math.floor((minX - geotransform[0]) / geotransform[1]))
+    x1 = min(rasterWidth, math.ceil((maxX - geotransform[0]) / geotransform[1]))
+    y0 = max(0, math.floor((maxY - geotransform[3]) / geotransform[5]))
+    y1 = min(rasterHeight, math.ceil((minY - geotransform[3]) / geotransform[5]))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def maskLayer(geometries, projection):
+    # In-memory data source holding the geometries as one layer, for stripMask
+    layerDS = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = layerDS.CreateLayer("clip", osr.SpatialReference(projection) if projection else None, ogr.wkbMultiPolygon)
+    for geometry in geometries:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+    return layerDS
+
+
+def stripMask(layerDS, projection, geotransform, y, width, rows):
+    # Boolean array of rows x width, True under the geometries (by cell centre, like Clip), for the strip starting
+    # y rows down the window geotransform describes
+    stripTransform = (geotransform[0] + y * geotransform[2], geotransform[1], geotransform[2],
+                      geotransform[3] + y * geotransform[5], geotransform[4], geotransform[5])
+    maskDS = gdal.GetDriverByName("MEM").Create("", width, rows, 1, gdal.GDT_Byte)
+    maskDS.SetGeoTransform(stripTransform)
+    if projection:
+        maskDS.SetProjection(projection)
+    gdal.RasterizeLayer(maskDS, [1], layerDS.GetLayer(0), burn_values=[1])
+    inside = maskDS.GetRasterBand(1).ReadAsArray().astype(bool)
+    maskDS = None
+    return inside
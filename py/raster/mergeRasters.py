@@ -3,10 +3,16 @@ Geoprocessing Tool which builds clips and exports a single raster
 Additional options provided based on past projects
 '''
 
+keepMosaic = True       # keep the merged mosaic (in a mergeCache folder beside the output), so a re-run with a few
+                        # changed tiles only rewrites their windows of it instead of merging every tile again
+
 import arcpy
 import os
+import glob
+from osgeo import gdal
 import gdal_merge as gm
-from exportRaster import exportRaster
+from exportRaster import exportRaster, exportOutputs
+from runManifest import RunManifest, fileSignature, digest
 
 
 def mergeRasters(inputDirectory, bBuildPyramids, outputFormat, outputFile):
@@ -22,23 +28,118 @@ def mergeRasters(inputDirectory, bBuildPyramids, outputFormat, outputFile):
             arcpy.AddError(f"Multiple file formats found in input directory, cannot process!")
     arcpy.AddMessage(f"Found {rasterCount} rasters in {inputDirectory} with extension {extension}")
     arcpy.SetProgressor("default", f"Found {rasterCount} rasters with extension {extension}")
-    
-    # Merge rasters to TIFF with gdal_merge - it doesn't seem to work right to compress it
-    mergedRasterFile = os.path.join(arcpy.env.scratchFolder, "merged_raster.tif")
-    arcpy.AddMessage(f"Merging with GDAL...")
-    arcpy.SetProgressor("default", f"Merging with GDAL")
-    gm.main(['', '-o', mergedRasterFile, '-of', 'GTiff', '-ot', 'Byte', os.path.join(inputDirectory, rf"*{extension}")])
+
+    # The tiles in the order gdal_merge lays them down (later ones on top), and what the last run built from them
+    pattern = os.path.join(inputDirectory, rf"*{extension}")
+    tiles = gm.names_to_fileinfos(glob.glob(pattern))
+    signatures = {os.path.basename(tile.filename): fileSignature(tile.filename) for tile in tiles}
+    outName = os.path.splitext(os.path.basename(outputFile))[0]
+    manifest = RunManifest(os.path.join(os.path.dirname(outputFile), f"{outName}_manifest.json"),
+                           {"tool": "mergeRasters", "bBuildPyramids": bool(bBuildPyramids), "outputFormat": outputFormat, "keepMosaic": keepMosaic})
+    mosaicSignature = digest(*[f"{name}:{signature}" for name, signature in signatures.items()])
+    if manifest.reusable("output", mosaicSignature):
+        arcpy.AddMessage(f"No tiles have changed since {outputFile} was built; reusing it")
+        manifest.keep("output")
+        if manifest.entry("mosaic") is not None:
+            manifest.keep("mosaic")
+        aprx = arcpy.mp.ArcGISProject("CURRENT")
+        for output in exportOutputs(outputFormat, outputFile):
+            aprx.activeMap.addDataFromPath(output)
+        arcpy.AddMessage("Success!")
+        return
+
+    if keepMosaic:
+        mosaicDir = os.path.join(os.path.dirname(outputFile), "mergeCache")
+        os.makedirs(mosaicDir, exist_ok=True)
+        mergedRasterFile = os.path.join(mosaicDir, f"{outName}_mosaic.tif")
+    else:
+        mergedRasterFile = os.path.join(arcpy.env.scratchFolder, "merged_raster.tif")
+
+    # Only the windows under changed, added or removed tiles are redone, if the mosaic's layout is the same
+    footprints = {os.path.basename(tile.filename): tileFootprint(tile) for tile in tiles}
+    layout = mosaicLayout(tiles)
+    previous = manifest.entry("mosaic")
+    if keepMosaic and previous is not None and previous.get("layout") == layout and manifest.reusable("mosaic", previous["signature"]):
+        # (a changed tile's old window too, in case it shrank or moved, and the windows of removed tiles)
+        changed = [name for name in signatures if previous["tiles"].get(name) != signatures[name]]
+        windows = [footprints[name] for name in changed]
+        windows += [previous["footprints"][name] for name in previous["tiles"] if name not in signatures or name in changed]
+        arcpy.AddMessage(f"Updating {len(windows)} changed tile windows of the mosaic...")
+        arcpy.SetProgressor("default", f"Updating {len(windows)} changed tile windows of the mosaic")
+        updated = updateMosaic(mergedRasterFile, tiles, windows)
+        arcpy.AddMessage(f"Rewrote {updated:,} of {layout[1] * layout[2]:,} mosaic cells; the rest were reused")
+    else:
+        # Merge rasters to TIFF with gdal_merge - it doesn't seem to work right to compress it
+        # (gdal_merge adds to an existing file, so any old mosaic goes first)
+        if os.path.exists(mergedRasterFile):
+            os.remove(mergedRasterFile)
+        arcpy.AddMessage(f"Merging with GDAL...")
+        arcpy.SetProgressor("default", f"Merging with GDAL")
+        gm.main(['', '-o', mergedRasterFile, '-of', 'GTiff', '-ot', 'Byte', pattern])
+    if keepMosaic:
+        manifest.record("mosaic", digest(mosaicSignature, "mosaic"), [mergedRasterFile], tiles=signatures, footprints=footprints, layout=layout)
 
     # call exportRaster to save (also will add to current map)
     arcpy.SetProgressor("default", f"Saving {outputFile}")
     arcpy.AddMessage(f"Saving {outputFile}")
+    outputs = exportOutputs(outputFormat, outputFile)
+    for output in outputs:
+        if arcpy.Exists(output):
+            arcpy.management.Delete(output)
     exportRaster(mergedRasterFile, bBuildPyramids, outputFormat, outputFile)
+    manifest.record("output", mosaicSignature, outputs)
+    manifest.save()
 
     # remove temp files
-    arcpy.management.Delete(mergedRasterFile)
+    if not keepMosaic:
+        arcpy.management.Delete(mergedRasterFile)
 
 
     arcpy.AddMessage("Success!")
+
+
+def tileFootprint(tile):
+    return [tile.ulx, tile.uly, tile.lrx, tile.lry]
+
+
+def mosaicLayout(tiles):
+    # Extent, size and cell size of the mosaic gdal_merge would build from tiles (as it works them out)
+    ulx = min(tile.ulx for tile in tiles)
+    uly = max(tile.uly for tile in tiles)
+    lrx = max(tile.lrx for tile in tiles)
+    lry = min(tile.lry for tile in tiles)
+    geotransform = [ulx, tiles[0].geotransform[1], 0, uly, 0, tiles[0].geotransform[5]]
+    xsize = int((lrx - ulx) / geotransform[1] + 0.5)
+    ysize = int((lry - uly) / geotransform[5] + 0.5)
+    return [geotransform, xsize, ysize, tiles[0].bands]
+
+
+def updateMosaic(mosaicFile, tiles, windows):
+    # Redraw each window (ulx, uly, lrx, lry) of the mosaic from scratch, with every tile over it laid down in
+    # order, as gdal_merge would have; returns the number of cells rewritten
+    mosaic = gdal.Open(mosaicFile, gdal.GA_Update)
+    geotransform = mosaic.GetGeoTransform()
+    bands = mosaic.RasterCount
+    dataType = mosaic.GetRasterBand(1).DataType
+    cells = 0
+    for ulx, uly, lrx, lry in windows:
+        x0 = max(0, int((ulx - geotransform[0]) / geotransform[1] + 0.1))
+        y0 = max(0, int((uly - geotransform[3]) / geotransform[5] + 0.1))
+        x1 = min(mosaic.RasterXSize, int((lrx - geotransform[0]) / geotransform[1] + 0.5))
+        y1 = min(mosaic.RasterYSize, int((lry - geotransform[3]) / geotransform[5] + 0.5))
+        if x1 <= x0 or y1 <= y0:
+            continue
+        window = gdal.GetDriverByName("MEM").Create("", x1 - x0, y1 - y0, bands, dataType)
+        window.SetGeoTransform((geotransform[0] + x0 * geotransform[1], geotransform[1], 0, geotransform[3] + y0 * geotransform[5], 0, geotransform[5]))
+        for tile in tiles:
+            for band in range(1, min(bands, tile.bands) + 1):
+                tile.copy_into(window, band, band)
+        for band in range(1, bands + 1):
+            mosaic.GetRasterBand(band).WriteArray(window.GetRasterBand(band).ReadAsArray(), x0, y0)
+        cells += (x1 - x0) * (y1 - y0)
+        window = None
+    mosaic = None
+    return cells
     
 
 
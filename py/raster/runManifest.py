@@ -0,0 +1,89 @@
+'''
+Manifest of what a tool run built from what, kept as JSON next to the outputs, so a re-run only redoes the
+work whose inputs have changed
+Each entry has a signature (a hash of everything its outputs were built from: input files, the part of the clip
+geometry that matters, ...) and the size and time of each output. An entry can be reused if its signature is
+the same and its outputs are still there as they were left. A change to the tool options invalidates every entry
+Input files are identified by path, size and modification time, which costs nothing on folders of large
+orthophotos; hashContents hashes their contents instead, for inputs that lose their times when copied
+'''
+
+hashContents = False
+
+import os
+import json
+import hashlib
+
+manifestVersion = 1
+
+
+class RunManifest:
+    def __init__(self, path, settings):
+        # settings: the tool options (anything JSON can hold) the outputs depend on
+        self.path = path
+        self.settingsKey = digest(json.dumps(settings, sort_keys=True, default=str))
+        self.previous = {}
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            if data.get("version") == manifestVersion and data.get("settings") == self.settingsKey:
+                self.previous = data.get("entries", {})
+
+    def entry(self, name):
+        # What the previous run recorded for name, or None
+        return self.previous.get(name)
+
+    def reusable(self, name, signature):
+        # Whether name's outputs from the previous run were built from the same inputs and haven't been touched since
+        entry = self.previous.get(name)
+        if entry is None or entry["signature"] != signature:
+            return False
+        for output, (size, mtime) in entry["outputs"].items():
+            outPath = self.outputPath(output)
+            if not os.path.exists(outPath) or os.path.getsize(outPath) != size or os.stat(outPath).st_mtime_ns != mtime:
+                return False
+        return True
+
+    def record(self, name, signature, outputs, **extra):
+        # outputs: paths written for name; extra: anything else to keep with the entry
+        self.entries[name] = dict(extra, signature=signature, outputs={
+            os.path.relpath(output, os.path.dirname(self.path)): [os.path.getsize(output), os.stat(output).st_mtime_ns] for output in outputs
+        })
+
+    def keep(self, name):
+        # Carry name's entry over from the previous run unchanged
+        self.entries[name] = self.previous[name]
+
+    def staleOutputs(self):
+        # Outputs of the previous run that nothing in this run has recorded
+        current = {output for entry in self.entries.values() for output in entry["outputs"]}
+        return [self.outputPath(output) for entry in self.previous.values() for output in entry["outputs"] if output not in current]
+
+    def outputPath(self, output):
+        return os.path.join(os.path.dirname(self.path), output)
+
+    def save(self):
+        # Written under a temp name and renamed, so an interrupted run never leaves half a manifest
+        tempPath = self.path + ".tmp"
+        with open(tempPath, "w", encoding="utf-8") as f:
+            json.dump({"version": manifestVersion, "settings": self.settingsKey, "entries": self.entries}, f, indent=1)
+        os.replace(tempPath, self.path)
+
+
+def fileSignature(path):
+    stat = os.stat(path)
+    if not hashContents:
+        return digest(f"{os.path.abspath(path)}\n{stat.st_size}\n{stat.st_mtime_ns}")
+    contents = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            contents.update(chunk)
+    return digest(f"{os.path.abspath(path)}\n{stat.st_size}\n{contents.hexdigest()}")
+
+
+def digest(*parts):
+    return hashlib.sha1("\n".join(str(part) for part in parts).encode("utf-8")).hexdigest()